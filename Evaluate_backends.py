@@ -0,0 +1,207 @@
+#  ======================== CMA-Based Symbolic Regressor ========================== #
+# Project:          Symbolic regression for physics
+# Name:             Evaluate_backends.py
+# Authors:          Jean-Philippe Bruneton
+# Date:             2020
+# License:          BSD 3-Clause License
+# ============================================================================ #
+
+
+# ================================= PREAMBLE ================================= #
+# Packages
+import numpy as np
+import config
+import functools
+import Evaluate_rpn
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# ============================================================================ #
+# evaluation backends : the values and the mean squared residual of an equation for a whole cma population X
+# (popsize, n_constants), on the data of one fit. A backend is built per fit by get_backend :
+#   - NumpyBackend : the reference, the compiled equation broadcast over the population (one array per operation)
+#   - NumbaBackend : one loop over the population and the data points generated per equation and jit compiled,
+#     without any intermediate array. Scalar mode only, needs numba ; used from config.jit_min_points points
+
+def get_backend(compiled, x, f, fp, E, objective):
+    if config.evaluation_backend == 'numba' and np.size(objective) >= config.jit_min_points:
+        if numba is None:
+            warn_no_numba()
+        else:
+            backend = NumbaBackend.build(compiled, x, f, fp, E, objective)
+            if backend is not None:
+                return backend
+    return NumpyBackend(compiled, x, f, fp, E, objective)
+
+@functools.lru_cache(maxsize=1)
+def warn_no_numba():
+    print('numba is not installed : evaluation falls back to the numpy backend')
+
+# ============================ CLASS: NumpyBackend ================================ #
+class NumpyBackend:
+
+    def __init__(self, compiled, x, f, fp, E, objective):
+        self.compiled = compiled
+        self.data = (x, f, fp, E)
+        self.objective = objective
+
+    # ---------------------------------------------------------------------------- #
+    def evaluate(self, X, buffers = None):
+        ''' values for the population X : each S[i] is a (popsize, 1, 1) column, so the equation returns a
+        (popsize, n_points, ...) array. With buffers (see Evaluate_rpn.RPNProgram), only valid until the next call '''
+        S = X.T.reshape(X.shape[1], X.shape[0], 1, 1)
+        x, f, fp, E = self.data
+        if buffers is not None and isinstance(self.compiled, Evaluate_rpn.RPNProgram):
+            return self.compiled(x, f, fp, S, E, buffers)
+        return self.compiled(x, f, fp, S, E)
+
+    # ---------------------------------------------------------------------------- #
+    def residual(self, X, buffers = None):
+        ''' mean squared residual of each candidate of X, None if the broadcast cannot express the equation
+        (or it does not depend on the data) : then the caller evaluates one candidate at a time '''
+        popsize = X.shape[0]
+        try:
+            result = self.evaluate(X, buffers)
+        except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+            return None
+
+        if type(result) != np.ndarray or result.ndim != self.objective.ndim + 1 or result.shape[0] != popsize \
+                or result.size == popsize:
+            return None
+
+        # without temporaries : an overflow also gets the sentinel
+        shape = np.broadcast(result, self.objective).shape
+        if buffers is None:
+            diff = np.subtract(result, self.objective)
+        else:
+            diff = np.subtract(result, self.objective, out=Evaluate_rpn.scratch(buffers, ('residual', shape)))
+        diff = diff.reshape(popsize, -1)
+        err = np.einsum('ij,ij->i', diff, diff) / diff.shape[1]
+        err[~np.isfinite(err)] = 1200000
+        return err
+
+# ============================ CLASS: NumbaBackend ================================ #
+class NumbaBackend(NumpyBackend):
+
+    # scalar code of the kernels (python or numpy functions numba knows)
+    unary_code = {np.cos: 'np.cos', np.sin: 'np.sin', np.tan: 'np.tan', np.exp: 'np.exp', np.log: 'np.log',
+                  np.sqrt: 'np.sqrt', np.sinh: 'np.sinh', np.cosh: 'np.cosh', np.tanh: 'np.tanh',
+                  np.arcsin: 'np.arcsin', np.arccos: 'np.arccos', np.arctan: 'np.arctan', np.log10: 'np.log10'}
+    binary_code = {np.add: '+', np.subtract: '-', np.multiply: '*', np.true_divide: '/', np.power: '**'}
+
+    def __init__(self, compiled, x, f, fp, E, objective, kernel, rows):
+        NumpyBackend.__init__(self, compiled, x, f, fp, E, objective)
+        self.kernel = kernel
+        # the data the kernel reads, one row per leaf (variables, targets, parts without constants), flattened
+        self.rows = rows
+        self.flat_objective = np.ascontiguousarray(objective, dtype=float).reshape(-1)
+
+    # ---------------------------------------------------------------------------- #
+    @classmethod
+    def build(cls, compiled, x, f, fp, E, objective):
+        # None if the equation uses something the scalar kernels do not have (vectors, dot, cross, norm...)
+        if not isinstance(compiled, Evaluate_rpn.RPNProgram) or compiled.calculus_mode != 'scalar':
+            return None
+        if isinstance(compiled, Evaluate_rpn.BoundProgram) and not compiled.bound_to(x, f, fp):
+            compiled = compiled.program
+        n_points = np.size(objective)
+
+        rows = []
+        def row(array):
+            array = np.asarray(array, dtype=float)
+            if array.size != n_points:
+                raise ValueError
+            rows.append(array.reshape(-1))
+            return 'D[%d, i]' % (len(rows) - 1)
+
+        # one line per instruction ; those without data are computed once per candidate, out of the loop on points
+        per_candidate = []
+        per_point = []
+        stack = []
+        try:
+            for k, (opcode, argument) in enumerate(compiled.instructions):
+                name = 't' + str(k)
+                if opcode == Evaluate_rpn.BINARY:
+                    (right, right_data), (left, left_data) = stack.pop(), stack.pop()
+                    code, on_data = '(%s %s %s)' % (left, cls.binary_code[argument], right), left_data or right_data
+                elif opcode == Evaluate_rpn.UNARY:
+                    operand, on_data = stack.pop()
+                    code = '%s(%s)' % (cls.unary_code[argument], operand)
+                elif opcode == Evaluate_rpn.SCALAR:
+                    code, on_data = 'C[p, %d]' % argument, False
+                elif opcode == Evaluate_rpn.VARIABLE:
+                    code, on_data = row(x[argument]), True
+                elif opcode == Evaluate_rpn.TARGET:
+                    code, on_data = row(f[argument]), True
+                elif opcode == Evaluate_rpn.DERIVATIVE:
+                    code, on_data = row(fp[argument]), True
+                elif opcode == Evaluate_rpn.LITERAL and np.size(argument) == 1:
+                    code, on_data = literal_code(float(np.asarray(argument).reshape(-1)[0])), False
+                elif opcode == Evaluate_rpn.LITERAL:
+                    code, on_data = row(argument), True
+                else:
+                    return None
+                if on_data:
+                    per_point.append(name + ' = ' + code)
+                else:
+                    per_candidate.append(name + ' = ' + code)
+                stack.append((name, on_data))
+        except (KeyError, ValueError, IndexError, TypeError):
+            return None
+
+        # equations that do not depend on the data are rejected by the numpy backend : keep it that way
+        if len(stack) != 1 or not stack[0][1]:
+            return None
+        source = '\n'.join(['def kernel(C, D, objective, err):',
+                            '    n = objective.shape[0]',
+                            '    for p in range(C.shape[0]):'] +
+                           ['        ' + line for line in per_candidate] +
+                           ['        total = 0.',
+                            '        for i in range(n):'] +
+                           ['            ' + line for line in per_point] +
+                           ['            diff = %s - objective[i]' % stack[0][0],
+                            '            total += diff*diff',
+                            '        err[p] = total / n'])
+        if len(rows) == 0:
+            rows.append(np.zeros(n_points))
+
+        # numba compiles the kernel at its first call : whatever it cannot type or compile is left to the numpy backend
+        try:
+            backend = cls(compiled, x, f, fp, E, objective, jit(source), np.vstack(rows))
+            backend.residual(np.zeros((1, compiled.scalar_numbers)))
+        except Exception as error:
+            warn_numba_failed(type(error).__name__)
+            return None
+        return backend
+
+    # ---------------------------------------------------------------------------- #
+    def residual(self, X, buffers = None):
+        err = np.empty(X.shape[0])
+        with np.errstate(all='ignore'):
+            self.kernel(np.ascontiguousarray(X, dtype=float), self.rows, self.flat_objective, err)
+        err[~np.isfinite(err)] = 1200000
+        return err
+
+# ---------------------------------------------------------------------------- #
+def literal_code(value):
+    # a number numba can type (np.float64('1.0') would be a cast from a string)
+    if np.isnan(value):
+        return 'np.nan'
+    elif np.isinf(value):
+        return 'np.inf' if value > 0 else '-np.inf'
+    return repr(value)
+
+@functools.lru_cache(maxsize=1)
+def warn_numba_failed(error):
+    print('numba could not compile an equation (' + error + ') : it falls back to the numpy backend')
+
+@functools.lru_cache(maxsize=config.formula_cache_size)
+def jit(source):
+    # equations with the same structure share their kernel : the data and the constants are arguments
+    namespace = {'np': np}
+    exec(source, namespace)
+    # numpy semantics for division by zero and domain errors (inf and nan, not exceptions)
+    return numba.njit(error_model='numpy')(namespace['kernel'])
@@ -13,17 +13,44 @@ import numpy as np
 import config
 import copy
 import cma
+import functools
+import hashlib
+import Evaluate_rpn
+import Evaluate_backends
 from scipy import interpolate
+from scipy.optimize import least_squares
 from numpy import linalg as la
 import random
 
+# ---------------------------------------------------------------------------- #
+@functools.lru_cache(maxsize=config.formula_cache_size)
+def compile_formula(formula, calculus_mode):
+    ''' turns a renamed formula into a function of (x, f, fp, S, E), parsed and compiled only once per process.
+    The cache is keyed by the renamed formula text, so every equation fitted again (and every objective call) reuses it '''
+    if calculus_mode == 'vectorial':
+        arguments = 'x, F, Fp, S, E'
+    else:
+        arguments = 'x, f, fp, S, E'
+    try:
+        return eval('lambda ' + arguments + ': ' + formula, {'np': np, 'la': la})
+    except SyntaxError:
+        return None
+
+# ---------------------------------------------------------------------------- #
+def stratified_indices(n, fraction, minimum):
+    # evenly spaced indices of about fraction*n points out of n, and at least minimum (if there are as many)
+    size = min(n, max(int(fraction*n), minimum))
+    return np.unique(np.linspace(0, n - 1, size).astype(int))
+
 # ============================ CLASS: Evaluate_Fit ================================ #
 # A class returning the reward of a given equation w.r.t. the target data (or function)
 class Evaluatefit:
 
-    def __init__(self, formulas, voc, train_targets, mode, u, look_for):
+    def __init__(self, formulas, voc, train_targets, mode, u, look_for, rpn = None, initial_A = None):
         self.calculus_mode = voc.calculus_mode
         self.formulas = copy.deepcopy(formulas)
+        self.rpn = rpn
+        self.initial_A = initial_A
         self.train_targets = train_targets
         self.u = u
         self.look_for = look_for
@@ -31,6 +58,14 @@ class Evaluatefit:
         self.n_variables = self.voc.n_variables
         self.mode = mode
         self.scalar_numbers = 0
+        self.v_numbers = 0
+        self.compiled = None
+        self.backend = None
+        self.terms = []
+        self.linear_indices = []
+        self.nonlinear_indices = []
+        self.max_evaluations = None
+        self.buffers = {}
         self.maximal_size = voc.maximal_size
         if self.calculus_mode == 'vectorial':
             self.variable = [self.train_targets[0][1][0]] #000 is the name # the variable is shared for all files so it doesnt depend on u
@@ -51,7 +86,7 @@ class Evaluatefit:
         self.array_functions = [x[2] for x in self.train_targets]
         self.array_first_der = [x[3] for x in self.train_targets]
         self.size = self.variable[0].size
-        self.ones = np.ones(self.variable[0].size)
+        self.basis = np.eye(3) # a vector B is A*E[0] + A*E[1] + A*E[2] : a (3,) row that broadcasts on data and on cma populations
 
         if look_for == 'find_2nd_order_diff_eq':
             self.maxder = 2
@@ -68,10 +103,153 @@ class Evaluatefit:
             self.objectivefunction = self.mytarget_function
 
         #print('obj shape', self.objectivefunction.shape)
+
+    # ---------------------------------------------------------------------------- #
+    def subsampled_data(self, fraction, min_points):
+        ''' variables, targets, first derivatives and objective on a fraction of the data points (at least min_points),
+        evenly spaced : thus stratified along each variable '''
+        if self.calculus_mode == 'scalar' and self.n_variables > 1:
+            # meshgrids : subsample each axis
+            axes = self.variable[0].ndim
+        else:
+            axes = 1
+        fraction = fraction**(1./axes)
+        minimum = int(np.ceil(min_points**(1./axes)))
+
+        def cut(array):
+            if array is None:
+                return None
+            index = tuple(stratified_indices(array.shape[axis], fraction, minimum) for axis in range(axes))
+            return array[np.ix_(*index)] if axes > 1 else array[index[0]]
+
+        return [cut(x) for x in self.variable], [cut(x) for x in self.array_functions], \
+               [cut(x) for x in self.array_first_der], cut(self.objectivefunction)
+
+    # ---------------------------------------------------------------------------- #
+    def subsample(self, fraction):
+        # keep only a fraction of the data points : a cheap fit for the first rounds of the racing in run_one_target
+        self.variable, self.array_functions, self.array_first_der, self.objectivefunction = \
+            self.subsampled_data(fraction, config.racing_min_points)
+        self.size = self.variable[0].size
+
+    # ---------------------------------------------------------------------------- #
+    def hopeless(self):
+        ''' cheap test before the fit : an equation that is not finite on the data whatever its constants would only
+        get the 1200000 sentinel from cma-es, so it gets the failure reward straight away '''
+        # the parts of the equation without free constants never change : a value outside the domain of a function
+        # (log or sqrt of negative numbers, arcsin beyond 1...) gives nan, and stays nan whatever the constants
+        if isinstance(self.compiled, Evaluate_rpn.RPNProgram):
+            try:
+                if isinstance(self.compiled, Evaluate_rpn.BoundProgram):
+                    values = self.compiled.values
+                else:
+                    values = Evaluate_rpn.bind(self.compiled, self.variable, self.array_functions, self.array_first_der, self.basis).values
+            except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+                return False
+            for value in values:
+                if np.any(np.isnan(value)):
+                    return True
+
+        # then a handful of random constants (and the inherited ones, if any) on a few points
+        n_constants = self.scalar_numbers + 3*self.v_numbers
+        # half of them where cma-es starts, half in a wider range
+        scales = np.where(np.arange(config.prescreen_samples) % 2 == 0, 1., config.prescreen_scale)
+        X = scales.reshape(-1, 1)*(2*np.random.rand(config.prescreen_samples, n_constants)-1)
+        if self.initial_A is not None:
+            X = np.vstack((X, self.initial_guess(n_constants)[0]))
+        popsize = X.shape[0]
+        variable, functions, first_der, objective = self.subsampled_data(0., config.prescreen_points)
+        try:
+            result = self.compiled(variable, functions, first_der, X.T.reshape(n_constants, popsize, 1, 1), self.basis)
+        except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+            return False
+
+        # as in evaluation_target_population : anything the broadcast cannot express is left to the fit
+        if type(result) != np.ndarray or result.ndim != objective.ndim + 1 or result.shape[0] != popsize:
+            return False
+        return not np.any(np.all(np.isfinite(result.reshape(popsize, -1)), axis=1))
+
+    # ---------------------------------------------------------------------------- #
+    def fingerprint(self):
+        ''' hash of the values of the equation on a few fixed points of the data, for two fixed pseudo random sets of
+        constants (in the order of the rpn) : equations equal up to the order of their operands or to an identity
+        (x0+x0 and two*x0, x0/x0 and one, A*x0 and x0*A) share it. None if these values are not all finite '''
+        compiled = Evaluate_rpn.compile_rpn(self.rpn, self.voc)
+        n_constants = compiled.scalar_numbers + 3*compiled.v_numbers
+        S = np.random.RandomState(config.fingerprint_seed).uniform(0.5, 1.5, (n_constants, 2, 1, 1))
+        variable, functions, first_der, objective = self.subsampled_data(0., config.fingerprint_points)
+        try:
+            with np.errstate(all='ignore'):
+                result = np.asarray(compiled(variable, functions, first_der, S, self.basis), dtype=float)
+        except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+            return None
+        if not np.all(np.isfinite(result)):
+            return None
+
+        # rounded to config.fingerprint_digits significant digits
+        mantissa, exponent = np.frexp(result)
+        mantissa = np.round(mantissa*10**config.fingerprint_digits) + 0. # no -0.
+        digest = hashlib.sha1(str([compiled.scalar_numbers, compiled.v_numbers, result.shape]).encode())
+        digest.update(mantissa.tobytes())
+        digest.update(exponent.tobytes())
+        return digest.hexdigest()
+
+    # ---------------------------------------------------------------------------- #
+    def compile_equation(self):
+        ''' get the function evaluating the equation : straight from the rpn when we have it, else from the renamed formula '''
+        if self.rpn is not None and config.evaluation_engine == 'rpn':
+            self.compiled = Evaluate_rpn.compile_rpn(self.rpn, self.voc)
+            self.scalar_numbers = self.compiled.scalar_numbers
+            self.v_numbers = self.compiled.v_numbers
+            if config.precompute_constant_free:
+                try:
+                    self.compiled = Evaluate_rpn.bind(self.compiled, self.variable, self.array_functions, self.array_first_der, self.basis)
+                except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+                    pass
+            if config.variable_projection:
+                self.init_projection()
+        else:
+            self.rename_formulas()
+        self.backend = Evaluate_backends.get_backend(self.compiled, self.variable, self.array_functions, self.array_first_der,
+                                                     self.basis, self.objectivefunction)
+
+    # ---------------------------------------------------------------------------- #
+    def init_projection(self):
+        # variable projection : get the free constants the equation is linear in (see Evaluate_rpn.linear_terms);
+        # these are solved by least squares, and cma only deals with the others
+        self.terms = Evaluate_rpn.linear_terms(self.compiled)
+        self.linear_indices = []
+        for sign, term, factor in self.terms:
+            if factor is not None:
+                opcode, index = factor
+                if opcode == Evaluate_rpn.VECTOR:
+                    self.linear_indices += [index, index + 1, index + 2]
+                else:
+                    self.linear_indices.append(index)
+        n_constants = self.scalar_numbers + 3*self.v_numbers
+        self.nonlinear_indices = [i for i in range(n_constants) if i not in self.linear_indices]
+
     # ---------------------------------------------------------------------------- #
     def rename_formulas(self):
         ''' index all the scalar 'A' by a A1, A2, etc, rename properly the differentials, and finally resize as it must '''
 
+        # pure numbers first, on the raw formula : done later, 'one' would also hit the 'ones' of the vectors B
+        string_to_replace = 'one'
+        replace_by = '1.0'
+        self.formulas = self.formulas.replace(string_to_replace, replace_by)
+
+        string_to_replace = 'two'
+        replace_by = '2.0'
+        self.formulas = self.formulas.replace(string_to_replace, replace_by)
+
+        string_to_replace = 'neutral'
+        replace_by = '1.0'
+        self.formulas = self.formulas.replace(string_to_replace, replace_by)
+
+        string_to_replace = 'zero'
+        replace_by = '0.0'
+        self.formulas = self.formulas.replace(string_to_replace, replace_by)
+
         self.scalar_numbers = self.formulas.count('A')
         self.v_numbers = self.formulas.count('B')
 
@@ -95,7 +273,7 @@ class Evaluatefit:
 
             #first rename B to an array of scalars:
             string_to_replace = 'B'
-            replace_by = 'np.transpose(np.array([A*ones,A*ones,A*ones]))'
+            replace_by = '(A*E[0]+A*E[1]+A*E[2])'
             self.formulas = self.formulas.replace(string_to_replace, replace_by)
             count = 0
 
@@ -169,9 +347,6 @@ class Evaluatefit:
         string_to_replace = 'SIZE'
         replace_by = str(self.size)
         neweq = neweq.replace(string_to_replace, replace_by)
-        string_to_replace = 'ones'
-        replace_by = 'self.ones'
-        neweq = neweq.replace(string_to_replace, replace_by)
 
         if config.specialgal:
             if config.loglog:
@@ -180,28 +355,15 @@ class Evaluatefit:
             else:
                 neweq = '('+neweq+')'+'*S[' + str(self.scalar_numbers -1) + ']'
 
-        string_to_replace = 'one'
-        replace_by = '1.0'
-        neweq = neweq.replace(string_to_replace, replace_by)
-
-        string_to_replace = 'two'
-        replace_by = '2.0'
-        neweq = neweq.replace(string_to_replace, replace_by)
-
-        string_to_replace = 'neutral'
-        replace_by = '1.0'
-        neweq = neweq.replace(string_to_replace, replace_by)
-
-        string_to_replace = 'zero'
-        replace_by = '0.0'
-        neweq = neweq.replace(string_to_replace, replace_by)
-
         self.formulas = neweq
+        self.compiled = compile_formula(self.formulas, self.calculus_mode)
 
     # ---------------------------------------------------------------------------- #
     def formula_eval(self, x, f, fp, S) :
+        if self.compiled is None:
+            return False, None
         try:
-            mafonction = eval(self.formulas)
+            mafonction = self.compiled(x, f, fp, S, self.basis)
             if type(mafonction) != np.ndarray or np.isnan(np.sum(mafonction)) or np.isinf(np.sum(mafonction)) :
                 return False, None
             else:
@@ -214,8 +376,10 @@ class Evaluatefit:
 
     # ------------------
     def formula_eval_vectorial(self, x, F, Fp, S) :
+        if self.compiled is None:
+            return False, None
         try:
-            mafonction = eval(self.formulas)
+            mafonction = self.compiled(x, F, Fp, S, self.basis)
             if type(mafonction) != np.ndarray or np.isnan(np.sum(mafonction)) or np.isinf(np.sum(mafonction)) :
                 return False, None
             else:
@@ -232,7 +396,7 @@ class Evaluatefit:
         if success == True:
             diff = evalfunc - self.objectivefunction
             err += (np.sum(diff ** 2))
-            err /= np.sum(np.ones_like(diff))
+            err /= diff.size
         else:
             return 1200000
 
@@ -246,13 +410,184 @@ class Evaluatefit:
         if success == True:
             diff = evalfunc - self.objectivefunction
             err += (np.sum(diff**2))
-            err /= np.sum(np.ones_like(diff))
+            err /= diff.size
 
         else:
             return 1200000
 
         return err
 
+    # ---------------------------------------------------------------------------- #
+    def evaluation_target_population(self, X):
+        ''' objective for a whole cma population X of shape (popsize, n_constants), in one pass of the evaluation
+        backend (see Evaluate_backends) '''
+        err = self.backend.residual(X, self.buffers if config.preallocated_buffers else None)
+
+        # anything the broadcast cannot express (or a formula that does not depend on the data) : one candidate at a time
+        if err is None:
+            if self.calculus_mode == 'vectorial':
+                return [self.evaluation_target_vectorial(x) for x in X]
+            else:
+                return [self.evaluation_target(x) for x in X]
+
+        return list(err)
+
+    # ---------------------------------------------------------------------------- #
+    def projection_target_population(self, X):
+        ''' objective of the nonlinear constants only, for a population X of shape (popsize, n_nonlinear) : for each
+        candidate the linear constants are solved by least squares. Returns the errors, and the linear constants '''
+        popsize = X.shape[0]
+        S = np.zeros((len(self.linear_indices) + len(self.nonlinear_indices), popsize, 1, 1))
+        S[self.nonlinear_indices] = X.T.reshape(-1, popsize, 1, 1)
+        shape = (popsize,) + self.objectivefunction.shape
+        solutions = np.zeros((popsize, len(self.linear_indices)))
+
+        # each linear constant gives one column : its term evaluated with the constant set to one (or to a unit vector)
+        rest = np.zeros(shape)
+        columns = []
+        try:
+            for sign, term, factor in self.terms:
+                if factor is None:
+                    rest = rest + sign*term(self.variable, self.array_functions, self.array_first_der, S, self.basis)
+                else:
+                    opcode, index = factor
+                    for unit in range(index, index + (3 if opcode == Evaluate_rpn.VECTOR else 1)):
+                        unit_S = S.copy()
+                        unit_S[unit] = 1.
+                        column = sign*term(self.variable, self.array_functions, self.array_first_der, unit_S, self.basis)
+                        columns.append(np.broadcast_to(column, shape).reshape(popsize, -1))
+
+            design = np.stack(columns, axis=2)
+            target = self.objectivefunction.reshape(1, -1) - np.broadcast_to(rest, shape).reshape(popsize, -1)
+        except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+            return [1200000]*popsize, solutions
+
+        errors = []
+        for p in range(popsize):
+            if not (np.isfinite(np.sum(design[p])) and np.isfinite(np.sum(target[p]))):
+                errors.append(1200000)
+                continue
+            try:
+                solutions[p] = np.linalg.lstsq(design[p], target[p], rcond=None)[0]
+            except np.linalg.LinAlgError:
+                errors.append(1200000)
+                continue
+            residual = target[p] - design[p].dot(solutions[p])
+            errors.append(residual.dot(residual) / residual.size)
+
+        return errors, solutions
+
+    # ---------------------------------------------------------------------------- #
+    def cmaes_fit(self, initialguess, initialsigma, objective, population_objective = None):
+        # run cma-es, either one candidate per call or with the whole population at once (ask and tell)
+        if population_objective is None:
+            population_objective = self.evaluation_target_population
+        # no outcmaes/ log files : thousands of fits run in parallel
+        options = {'verb_disp': 0, 'verb_log': 0}
+        if self.max_evaluations is not None:
+            options['maxfevals'] = self.max_evaluations
+        es = cma.CMAEvolutionStrategy(initialguess, initialsigma, options)
+        if config.batched_cmaes:
+            while not es.stop():
+                X = es.ask()
+                es.tell(X, population_objective(np.array(X)))
+            return es.result
+        else:
+            return es.optimize(objective).result
+
+    # ---------------------------------------------------------------------------- #
+    def residuals_and_jacobian(self, S):
+        # residuals of the fit at S, and their derivatives with respect to S (forward mode, through the rpn program)
+        value, derivative = self.compiled.differentiate(self.variable, self.array_functions, self.array_first_der, S, self.basis)
+        shape = self.objectivefunction.shape
+        residuals = (np.broadcast_to(value, shape) - self.objectivefunction).ravel()
+        if derivative is None:
+            jacobian = np.zeros((residuals.size, len(S)))
+        else:
+            jacobian = np.broadcast_to(Evaluate_rpn.lift(derivative, len(shape)), (len(S),) + shape).reshape(len(S), -1).T
+        return residuals, jacobian
+
+    # ---------------------------------------------------------------------------- #
+    def least_squares_fit(self, initialguess):
+        ''' levenberg-marquardt from initialguess, with the analytic jacobian : returns the constants found '''
+        # residuals and jacobian come from the same pass : keep the last one for the jac call that follows
+        last = {}
+        def evaluate(S):
+            key = S.tobytes()
+            if key not in last:
+                last.clear()
+                last[key] = self.residuals_and_jacobian(S)
+            return last[key]
+
+        # lm needs at least as many residuals as constants
+        method = 'lm' if self.objectivefunction.size >= len(initialguess) else 'trf'
+        res = least_squares(lambda S: evaluate(S)[0], initialguess, jac=lambda S: evaluate(S)[1], method=method,
+                            max_nfev=config.least_squares_max_nfev)
+        return res.x
+
+    # ---------------------------------------------------------------------------- #
+    def refine_constants(self, rec):
+        # local polish of the constants found by cma-es, kept only if it lowers the objective
+        if not config.gradient_refinement or not isinstance(self.compiled, Evaluate_rpn.RPNProgram) or len(rec) == 0:
+            return rec
+        try:
+            refined = self.least_squares_fit(np.array(rec, dtype=float))
+        except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+            return rec
+        if not np.all(np.isfinite(refined)):
+            return rec
+        before, after = self.evaluation_target_population(np.array([rec, refined]))
+        if after < before:
+            return list(refined)
+        return rec
+
+    # -------------------------------------------------------------------------------  #
+    def initial_guess(self, n_constants):
+        # random start, unless constants were inherited from the parents : then start there, with a small sigma.
+        # Constants the parents did not have are random, and the extra one added for cma (if any) starts at zero
+        guess = 2*np.random.rand(n_constants)-1
+        if self.initial_A is None or not config.warm_start:
+            return guess, np.random.randint(1,5)
+
+        inherited = np.array(self.initial_A[:n_constants], dtype=float)
+        known = np.isfinite(inherited)
+        guess[:inherited.size][known] = inherited[known]
+        if not config.specialgal:
+            guess[inherited.size:] = 0
+        return guess, config.warm_start_sigma
+
+    # -------------------------------------------------------------------------------  #
+    def least_squares_only(self):
+        # few constants : levenberg-marquardt from random starts is much cheaper than cma-es (but a pure linear
+        # regression is better done by the variable projection)
+        n_constants = self.scalar_numbers + 3*self.v_numbers
+        if not isinstance(self.compiled, Evaluate_rpn.RPNProgram) or n_constants > config.least_squares_max_constants:
+            return False
+        return len(self.linear_indices) == 0 or len(self.nonlinear_indices) > 0
+
+    # -------------------------------------------------------------------------------  #
+    def best_A_least_squares(self):
+        n_constants = self.scalar_numbers + 3*self.v_numbers
+        best, best_error = [1]*n_constants, 1200000
+        for restart in range(config.least_squares_restarts):
+            # the inherited constants, if any, are the first start
+            if restart == 0:
+                initialguess, _ = self.initial_guess(n_constants)
+            else:
+                initialguess = 2*np.random.rand(n_constants)-1
+            try:
+                S = self.least_squares_fit(initialguess)
+            except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError, TypeError):
+                continue
+            if not np.all(np.isfinite(S)):
+                continue
+            error = self.evaluation_target_population(S.reshape(1, -1))[0]
+            if error < best_error:
+                best, best_error = list(S), error
+
+        # no start led anywhere : let cma-es try
+        return best_error < 1200000, best
+
     # ---------------------------------------------------------------------------- #
     def func(self, A, f, x):
         # eval the func, leaves only A undefined
@@ -260,14 +595,66 @@ class Evaluatefit:
         return eval(toeval)
 
     # -------------------------------------------------------------------------------  #
-    def best_A_cmaes(self):
-        # applies the cmaes fit:
-        initialguess = 2*np.random.rand(self.scalar_numbers)-1
-        initialsigma = np.random.randint(1,5)
+    def best_A_projected(self):
+        # cma-es only on the constants entering nonlinearly, the linear ones being solved in each objective call
+        n_nonlinear = len(self.nonlinear_indices)
+        n_constants = n_nonlinear + len(self.linear_indices)
+
+        try:
+            if n_nonlinear == 0:
+                # nothing left for cma : the fit is a linear regression
+                theta = np.zeros(0)
+            else:
+                # cmaes must be at least 2 dim : the extra coordinate, if any, is not used
+                guess, initialsigma = self.initial_guess(n_constants)
+                initialguess = 2*np.random.rand(max(n_nonlinear, 2))-1
+                initialguess[:n_nonlinear] = guess[self.nonlinear_indices]
+                res = self.cmaes_fit(initialguess, initialsigma,
+                                     lambda S: self.projection_target_population(np.array([S[:n_nonlinear]]))[0][0],
+                                     lambda X: self.projection_target_population(X[:, :n_nonlinear])[0])
+                theta = res.xfavorite[:n_nonlinear]
+
+            errors, solutions = self.projection_target_population(theta.reshape(1, -1))
+            # the mean of cma-es can sit where the projection fails (log of a negative constant...) : then its best point
+            if not self.projection_succeeded(errors, solutions) and n_nonlinear > 0 and res.xbest is not None:
+                theta = res.xbest[:n_nonlinear]
+                errors, solutions = self.projection_target_population(theta.reshape(1, -1))
+
+        except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError):
+            return False, [1]*n_constants
+
+        # else plain cma-es on all the constants
+        if not self.projection_succeeded(errors, solutions):
+            if self.calculus_mode == 'vectorial':
+                return self.best_vectorial_cmaes(projection = False)
+            return self.best_A_cmaes(projection = False)
+
+        rec = [0.]*n_constants
+        for i, index in enumerate(self.nonlinear_indices):
+            rec[index] = theta[i]
+        for i, index in enumerate(self.linear_indices):
+            rec[index] = solutions[0][i]
+
+        return True, self.refine_constants(rec)
+
+    def projection_succeeded(self, errors, solutions):
+        return np.isfinite(errors[0]) and errors[0] < 1200000 and np.all(np.isfinite(solutions))
+
+    # -------------------------------------------------------------------------------  #
+    def best_A_cmaes(self, projection = True):
+        # applies the cmaes fit (projection = False : on all the constants, when best_A_projected failed):
+        if projection and self.least_squares_only():
+            success, rec = self.best_A_least_squares()
+            if success:
+                return success, rec
+
+        if projection and len(self.linear_indices) > 0:
+            return self.best_A_projected()
+
+        initialguess, initialsigma = self.initial_guess(self.scalar_numbers)
 
         try:
-            res = cma.CMAEvolutionStrategy(initialguess, initialsigma,
-                {'verb_disp': 0}).optimize(self.evaluation_target).result
+            res = self.cmaes_fit(initialguess, initialsigma, self.evaluation_target)
 
             reco = res.xfavorite
             rec = []
@@ -279,17 +666,23 @@ class Evaluatefit:
 
             return False, [1]*self.scalar_numbers
 
-        return True, rec
+        return True, self.refine_constants(rec)
 
     # -------------------------------------------------------------------------------  #
-    def best_vectorial_cmaes(self):
-        # applies the cma-es fit:
-        initialguess = 2 * np.random.rand(self.scalar_numbers+3*self.v_numbers) - 1
-        initialsigma = np.random.randint(1, 5)
+    def best_vectorial_cmaes(self, projection = True):
+        # applies the cma-es fit (projection = False : on all the constants, when best_A_projected failed):
+        if projection and self.least_squares_only():
+            success, rec = self.best_A_least_squares()
+            if success:
+                return success, rec
+
+        if projection and len(self.linear_indices) > 0:
+            return self.best_A_projected()
+
+        initialguess, initialsigma = self.initial_guess(self.scalar_numbers+3*self.v_numbers)
 
         try:
-            res = cma.CMAEvolutionStrategy(initialguess, initialsigma,
-                                           {'verb_disp': 0}).optimize(self.evaluation_target_vectorial).result
+            res = self.cmaes_fit(initialguess, initialsigma, self.evaluation_target_vectorial)
             reco = res.xfavorite
             rec = []
             for u in range(reco.size):
@@ -298,7 +691,7 @@ class Evaluatefit:
         except (RuntimeWarning, RuntimeError, ValueError, ZeroDivisionError, OverflowError, SystemError, AttributeError) as e:
             print(e)
             return False, [1] * self.scalar_numbers
-        return True, rec
+        return True, self.refine_constants(rec)
 
     def testeval(self, x, S):
         mafonction = eval(self.formulas)
@@ -353,7 +746,7 @@ class Evaluatefit:
 
         if self.calculus_mode == 'scalar':
             allS = []
-            self.rename_formulas()
+            self.compile_equation()
             #print('toi', self.formulas)
             if self.scalar_numbers == 0:
                 rms = self.eval_reward_nrmse(allS)
@@ -361,6 +754,9 @@ class Evaluatefit:
                     rms = 100000000
                 return self.scalar_numbers, allS, rms
 
+            if config.prescreen and self.hopeless():
+                return self.scalar_numbers, [1] * self.scalar_numbers, 100000000
+
             # else: cmaes fit : ---------------------------------------------------------- #
             success, allS = self.best_A_cmaes()
             if success == False:
@@ -376,7 +772,7 @@ class Evaluatefit:
             return self.scalar_numbers, allS, rms
 
         else:
-            self.rename_formulas()
+            self.compile_equation()
             #print(self.formulas)
             allS = []
             if self.scalar_numbers == 0 and self.v_numbers == 0:
@@ -385,6 +781,9 @@ class Evaluatefit:
                     rms = 100000000
                 return self.scalar_numbers, allS, rms
 
+            if config.prescreen and self.hopeless():
+                return self.scalar_numbers + 3*self.v_numbers, [1] * (self.scalar_numbers+3*self.v_numbers), 100000000
+
             # else: cmaes fit : ---------------------------------------------------------- #
             success, allS = self.best_vectorial_cmaes()
 
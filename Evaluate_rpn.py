@@ -0,0 +1,541 @@
+#  ======================== CMA-Based Symbolic Regressor ========================== #
+# Project:          Symbolic regression for physics
+# Name:             Evaluate_rpn.py
+# Authors:          Jean-Philippe Bruneton
+# Date:             2020
+# License:          BSD 3-Clause License
+# ============================================================================ #
+
+
+# ================================= PREAMBLE ================================= #
+# Packages
+import numpy as np
+import config
+import functools
+import collections
+import hashlib
+import weakref
+
+# ============================================================================ #
+# numpy implementation of the vocabulary, keyed by the formula fragments of Build_dictionnaries
+
+# vectors are (..., 3) arrays : data (n_points, 3), constants B (3,) rows or (popsize, 1, 3) for cma populations
+def dot(a, b, out = None):
+    # one pass of einsum, instead of the (..., 3) product and its sum
+    return np.einsum('...i,...i->...', a, b, out=out)[..., np.newaxis]
+
+def norm(a, out = None):
+    result = dot(a, a, out)
+    return np.sqrt(result, out=result)
+
+def cross(a, b, out = None):
+    # component arithmetic, instead of the generic np.cross (and its moves of the last axis)
+    if np.shape(a)[-1:] != (3,) or np.shape(b)[-1:] != (3,):
+        return np.cross(a, b)
+    if out is None:
+        out = np.empty(np.broadcast(a, b).shape)
+    for i, j, k in [(0, 1, 2), (1, 2, 0), (2, 0, 1)]:
+        np.multiply(a[..., j], b[..., k], out=out[..., i])
+        out[..., i] -= a[..., k]*b[..., j]
+    return out
+
+unary_kernels = {'np.cos(': np.cos, 'np.sin(': np.sin, 'np.tan(': np.tan, 'np.exp(': np.exp, 'np.log(': np.log,
+                 'np.sqrt(': np.sqrt, 'np.sinh(': np.sinh, 'np.cosh(': np.cosh, 'np.tanh(': np.tanh,
+                 'np.arcsin(': np.arcsin, 'np.arccos(': np.arccos, 'np.arctan(': np.arctan, 'la.norm(': norm}
+
+binary_kernels = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.true_divide, '**': np.power,
+                  'np.vdot(': dot, 'np.cross(': cross}
+
+literal_values = {'one': 1.0, 'two': 2.0, 'neutral': 1.0, 'zero': 0.0, 'infinity': np.inf}
+
+# derivatives of the kernels, for forward mode differentiation : functions of the argument(s) and of the value
+unary_derivatives = {np.cos: lambda a, value: -np.sin(a), np.sin: lambda a, value: np.cos(a),
+                     np.tan: lambda a, value: 1 + value**2, np.exp: lambda a, value: value,
+                     np.log: lambda a, value: 1/a, np.sqrt: lambda a, value: 0.5/value,
+                     np.sinh: lambda a, value: np.cosh(a), np.cosh: lambda a, value: np.sinh(a),
+                     np.tanh: lambda a, value: 1 - value**2, np.arcsin: lambda a, value: 1/np.sqrt(1 - a**2),
+                     np.arccos: lambda a, value: -1/np.sqrt(1 - a**2), np.arctan: lambda a, value: 1/(1 + a**2),
+                     np.log10: lambda a, value: 1/(a*np.log(10))}
+
+# opcodes of the stack machine
+LITERAL, SCALAR, VECTOR, VARIABLE, TARGET, DERIVATIVE, UNARY, BINARY, HALT = range(9)
+
+# ---------------------------------------------------------------------------- #
+def decode_symbol(symbol):
+    # from a formula fragment to (opcode, argument)
+    if symbol == 'halt':
+        return HALT, None
+    elif symbol == 'A':
+        return SCALAR, None
+    elif symbol == 'B':
+        return VECTOR, None
+    elif symbol in literal_values:
+        return LITERAL, literal_values[symbol]
+    elif symbol in unary_kernels:
+        return UNARY, unary_kernels[symbol]
+    elif symbol in binary_kernels:
+        return BINARY, binary_kernels[symbol]
+    elif symbol[0] == 'x' and symbol[1:].isdigit():
+        return VARIABLE, int(symbol[1:])
+    elif symbol[0] in ['f', 'F'] and symbol[1:].isdigit():
+        return TARGET, int(symbol[1:])
+    elif symbol[0] == 'd' and symbol.count('_x0') == 1:
+        # first derivatives only : 'd_x0_f0' is the derivative of target 0
+        return DERIVATIVE, int(symbol.split('_')[-1][1:])
+    else:
+        print('symbol not supported by the rpn evaluator', symbol)
+        raise ValueError
+
+# ---------------------------------------------------------------------------- #
+def voc_signature(voc):
+    # everything the compiled program depends on, hashable: the same voc pickled to another worker has the same signature
+    return voc.calculus_mode, voc.n_variables, tuple(sorted(voc.numbers_to_formula_dict.items()))
+
+# ---------------------------------------------------------------------------- #
+def compile_rpn(rpn, voc):
+    ''' returns the (cached) stack machine program of an equation given in reverse polish notation '''
+    return _compile_rpn(tuple(rpn), voc_signature(voc))
+
+@functools.lru_cache(maxsize=config.formula_cache_size)
+def _compile_rpn(rpn, signature):
+    calculus_mode, n_variables, numbers_to_formula = signature
+    numbers_to_formula = dict(numbers_to_formula)
+    return build_program([numbers_to_formula[str(number)] for number in rpn], calculus_mode, n_variables)
+
+# ---------------------------------------------------------------------------- #
+def build_program(symbols, calculus_mode, n_variables):
+    # decode the symbols of an equation into the instructions of the stack machine, with the same conventions
+    # (and the same ordering of the free scalars S) as the renamed formulas of Evaluatefit
+    reshape_variables = calculus_mode == 'vectorial' or n_variables == 1
+    instructions = []
+    scalar_numbers = 0
+    v_numbers = 0
+    n_constants = 0
+
+    # free scalars are numbered in the order they are read, which is also their order in the infix formula
+    for symbol in symbols:
+        opcode, argument = decode_symbol(symbol)
+        if opcode == HALT:
+            continue
+        if opcode == SCALAR:
+            argument = n_constants
+            n_constants += 1
+            scalar_numbers += 1
+        elif opcode == VECTOR:
+            argument = n_constants
+            n_constants += 3
+            v_numbers += 1
+        instructions.append((opcode, argument))
+
+    if len(instructions) == 0:
+        return RPNProgram(instructions, calculus_mode, reshape_variables)
+
+    # cmaes must be at least 2 dim
+    if calculus_mode == 'scalar' and scalar_numbers == 1:
+        instructions += [(SCALAR, n_constants), (BINARY, np.add)]
+        n_constants += 1
+        scalar_numbers += 1
+    elif calculus_mode == 'vectorial' and scalar_numbers == 1 and v_numbers == 0:
+        instructions += [(VECTOR, n_constants), (BINARY, np.add)]
+        n_constants += 3
+        v_numbers += 1
+
+    # scale a_0
+    if config.specialgal:
+        scale = n_constants
+        scaled = []
+        for opcode, argument in instructions:
+            scaled.append((opcode, argument))
+            if opcode == VARIABLE and argument == 0:
+                if config.loglog:
+                    scaled += [(SCALAR, scale), (UNARY, np.log10), (BINARY, np.subtract)]
+                else:
+                    scaled += [(SCALAR, scale), (BINARY, np.true_divide)]
+        if config.loglog:
+            scaled += [(SCALAR, scale), (UNARY, np.log10), (BINARY, np.add)]
+        else:
+            scaled += [(SCALAR, scale), (BINARY, np.multiply)]
+        instructions = scaled
+        scalar_numbers += 1
+
+    return RPNProgram(instructions, calculus_mode, reshape_variables, scalar_numbers, v_numbers)
+
+# ---------------------------------------------------------------------------- #
+def to_tree(instructions):
+    # nodes are (opcode, argument, children)
+    stack = []
+    for opcode, argument in instructions:
+        if opcode == BINARY:
+            right = stack.pop()
+            stack[-1] = (opcode, argument, [stack[-1], right])
+        elif opcode == UNARY:
+            stack[-1] = (opcode, argument, [stack[-1]])
+        else:
+            stack.append((opcode, argument, []))
+    return stack[-1]
+
+def from_tree(node, instructions = None):
+    if instructions is None:
+        instructions = []
+    opcode, argument, children = node
+    for child in children:
+        from_tree(child, instructions)
+    instructions.append((opcode, argument))
+    return instructions
+
+# ---------------------------------------------------------------------------- #
+def depends_on_constants(node):
+    opcode, argument, children = node
+    if opcode == SCALAR or opcode == VECTOR:
+        return True
+    return any(depends_on_constants(child) for child in children)
+
+def bind(program, x, f, fp, E):
+    ''' the parts of the equation that involve no free constant do not change during the fit : compute them once on
+    the given data (identical parts only once), and return the equivalent program where they are literals '''
+    values = {}
+    if config.subtree_value_cache:
+        dataset = (program.calculus_mode, program.reshape_variables, data_key(x, f, fp, E))
+
+    def visit(node):
+        opcode, argument, children = node
+        if opcode == LITERAL:
+            return node
+        if not depends_on_constants(node):
+            key = tuple(from_tree(node))
+            if key not in values:
+                if config.subtree_value_cache:
+                    values[key] = cached_value(node, key, dataset, program, x, f, fp, E)
+                else:
+                    values[key] = RPNProgram(list(key), program.calculus_mode, program.reshape_variables)(x, f, fp, [], E)
+            return LITERAL, values[key], []
+        return opcode, argument, [visit(child) for child in children]
+
+    if len(program.instructions) == 0:
+        return BoundProgram(program, program.instructions, x, f, fp, [])
+    instructions = from_tree(visit(to_tree(program.instructions)))
+    return BoundProgram(program, instructions, x, f, fp, list(values.values()))
+
+# ---------------------------------------------------------------------------- #
+# values of the parts without free constants, kept by each process across fits (see ValueCache) : the same
+# subtrees (np.sin(x0), f0*x0, la.norm(F0)...) come back in many equations of the pool, on the same data
+
+def cached_value(node, key, dataset, program, x, f, fp, E):
+    # leaves are not kept (a variable is only a view of the data) ; on a miss, the operands come from the cache too
+    opcode, argument, children = node
+    if len(children) == 0:
+        return RPNProgram(list(key), program.calculus_mode, program.reshape_variables)(x, f, fp, [], E)
+    value = value_cache.get((dataset, key))
+    if value is None:
+        operands = []
+        for child in children:
+            child_key = tuple(from_tree(child))
+            operands.append((LITERAL, cached_value(child, child_key, dataset, program, x, f, fp, E)))
+        value = RPNProgram(operands + [(opcode, argument)], program.calculus_mode, program.reshape_variables)(x, f, fp, [], E)
+        value_cache.put((dataset, key), value)
+    return value
+
+def array_digest(array):
+    # sha1 of an array of the data, computed once per array object
+    entry = _digests.get(id(array))
+    if entry is not None and entry[0]() is array:
+        return entry[1]
+    values = np.ascontiguousarray(array)
+    digest = hashlib.sha1(str((values.shape, values.dtype.str)).encode())
+    digest.update(values.tobytes())
+    digest = digest.hexdigest()
+    try:
+        # the entry goes with the array
+        reference = weakref.ref(array, lambda reference, key = id(array): _digests.pop(key, None))
+    except TypeError:
+        return digest
+    _digests[id(array)] = (reference, digest)
+    return digest
+
+_digests = {}
+
+def data_key(x, f, fp, E):
+    # the data a fit is done on : datasets pickled again for each task (or subsampled by the racing) get the same key
+    # when they hold the same values
+    key = []
+    for arrays in [x, f, fp, [E]]:
+        key.append(tuple(None if array is None else array_digest(array) for array in arrays))
+    return tuple(key)
+
+# =============================== CLASS: ValueCache ================================ #
+# LRU of computed values, bounded by their size in bytes
+
+class ValueCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.values = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    # ---------------------------------------------------------------------------- #
+    def get(self, key):
+        value = self.values.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.values.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        # shared by all the fits of the process : read only
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        size = getattr(value, 'nbytes', 8)
+        if size > self.max_bytes:
+            return
+        if key in self.values:
+            self.bytes -= getattr(self.values.pop(key), 'nbytes', 8)
+        self.values[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, oldest = self.values.popitem(last=False)
+            self.bytes -= getattr(oldest, 'nbytes', 8)
+
+    def clear(self):
+        self.values.clear()
+        self.bytes = 0
+
+# =============================== END CLASS: ValueCache ================================ #
+
+value_cache = ValueCache(config.subtree_value_cache_bytes)
+
+# ---------------------------------------------------------------------------- #
+def split_sum(node, sign = 1.):
+    # the terms of the top level sum of the tree, with their sign
+    opcode, argument, children = node
+    if opcode == BINARY and argument is np.add:
+        return split_sum(children[0], sign) + split_sum(children[1], sign)
+    elif opcode == BINARY and argument is np.subtract:
+        return split_sum(children[0], sign) + split_sum(children[1], -sign)
+    else:
+        return [(sign, node)]
+
+def linear_factor(node):
+    # the free constant (scalar A or vector B) a term is proportional to, if any : the term itself, or a factor of
+    # a product, or the numerator of a quotient
+    opcode, argument, children = node
+    if opcode == SCALAR or opcode == VECTOR:
+        return opcode, argument
+    elif opcode == BINARY and argument is np.multiply:
+        factor = linear_factor(children[0])
+        if factor is None:
+            factor = linear_factor(children[1])
+        return factor
+    elif opcode == BINARY and argument is np.true_divide:
+        return linear_factor(children[0])
+    return None
+
+# ---------------------------------------------------------------------------- #
+def linear_terms(program):
+    ''' split an equation into the terms of its top level sum, and get the free constant each term is proportional to
+    (or None) : for fixed values of all other constants, the equation is linear in these ones.
+    returns a list of [sign, program of the term, (opcode, index of the constant) or None] '''
+    if config.specialgal or len(program.instructions) == 0:
+        return []
+    terms = []
+    for sign, node in split_sum(to_tree(program.instructions)):
+        term = RPNProgram(from_tree(node), program.calculus_mode, program.reshape_variables)
+        terms.append([sign, term, linear_factor(node)])
+    return terms
+
+# ---------------------------------------------------------------------------- #
+def lift(derivative, ndim):
+    # derivatives carry the free scalars along their first axis : align the other axes with a value of dimension ndim
+    if derivative is None:
+        return None
+    missing = ndim + 1 - derivative.ndim
+    return derivative.reshape(derivative.shape[:1] + (1,)*missing + derivative.shape[1:])
+
+def add_derivatives(da, db, sign = 1.):
+    # None stands for a value that does not depend on the free scalars
+    if db is None:
+        return da
+    elif da is None:
+        return sign*db
+    return da + sign*db
+
+def binary_derivative(kernel, a, b, value, da, db):
+    if kernel is np.add:
+        return add_derivatives(da, db)
+    elif kernel is np.subtract:
+        return add_derivatives(da, db, -1.)
+    elif kernel is np.multiply:
+        return add_derivatives(None if da is None else da*b, None if db is None else a*db)
+    elif kernel is np.true_divide:
+        return add_derivatives(None if da is None else da/b, None if db is None else -value*db/b)
+    elif kernel is np.power:
+        return add_derivatives(None if da is None else b*a**(b - 1)*da, None if db is None else value*np.log(a)*db)
+    elif kernel is dot:
+        return np.sum(add_derivatives(None if da is None else da*b, None if db is None else a*db), axis=-1, keepdims=True)
+    elif kernel is cross:
+        # np.cross needs the 3 components explicitly, even when a derivative is constant across them
+        return add_derivatives(None if da is None else np.cross(da + np.zeros(np.shape(a)), b),
+                               None if db is None else np.cross(a, db + np.zeros(np.shape(b))))
+    print('no derivative for', kernel)
+    raise ValueError
+
+def unary_derivative(kernel, a, value, da):
+    if kernel is norm:
+        return np.sum(a*da, axis=-1, keepdims=True)/value
+    return unary_derivatives[kernel](a, value)*da
+
+# ---------------------------------------------------------------------------- #
+def scratch(buffers, key):
+    # the work array of a given key, allocated on first use ; the last item of the key is its shape
+    if key not in buffers:
+        buffers[key] = np.empty(key[-1])
+    return buffers[key]
+
+def apply_into(kernel, operands, depth, buffers):
+    # kernel(*operands), written into the buffer of its slot in the stack : a slot holds one value at a time, so this
+    # buffer is either free or the left operand itself (computed in place, fine for ufuncs)
+    shape = np.broadcast(*operands).shape
+    if len(shape) == 0:
+        return kernel(*operands)
+    elif isinstance(kernel, np.ufunc):
+        return kernel(*operands, out=scratch(buffers, (depth, shape)))
+    elif kernel is dot or kernel is norm:
+        return kernel(*operands, out=scratch(buffers, (depth, 'dot', shape[:-1])))
+    elif kernel is cross:
+        # the components of the operands are read after the first ones are written : no computation in place
+        out = scratch(buffers, (depth, 'cross', shape))
+        if any(np.may_share_memory(out, operand) for operand in operands):
+            out = None
+        return cross(*operands, out=out)
+    return kernel(*operands)
+
+# =============================== CLASS: RPNProgram ================================ #
+# An equation compiled into a list of instructions; calling it evaluates it on numpy arrays
+
+class RPNProgram:
+
+    def __init__(self, instructions, calculus_mode, reshape_variables, scalar_numbers = 0, v_numbers = 0):
+        self.instructions = instructions
+        self.calculus_mode = calculus_mode
+        self.reshape_variables = reshape_variables
+        self.scalar_numbers = scalar_numbers
+        self.v_numbers = v_numbers
+
+    # ---------------------------------------------------------------------------- #
+    def __call__(self, x, f, fp, S, E, buffers = None):
+        # same signature as the compiled formulas of Evaluatefit : variables, targets, first derivatives, free scalars
+        # and the unit basis used to build vectors. With a dict of buffers (kept by the caller from one call to the
+        # next) the operators write into them, and the result is only valid until the next call
+        stack = []
+        for opcode, argument in self.instructions:
+            if opcode == BINARY:
+                right = stack.pop()
+                if buffers is None:
+                    stack[-1] = argument(stack[-1], right)
+                else:
+                    stack[-1] = apply_into(argument, (stack[-1], right), len(stack), buffers)
+            elif opcode == UNARY:
+                if buffers is None:
+                    stack[-1] = argument(stack[-1])
+                else:
+                    stack[-1] = apply_into(argument, (stack[-1],), len(stack), buffers)
+            elif opcode == SCALAR:
+                stack.append(S[argument])
+            elif opcode == VECTOR:
+                stack.append(S[argument]*E[0] + S[argument + 1]*E[1] + S[argument + 2]*E[2])
+            elif opcode == VARIABLE:
+                if self.reshape_variables:
+                    stack.append(x[argument].reshape(-1, 1))
+                else:
+                    stack.append(x[argument])
+            elif opcode == TARGET:
+                stack.append(f[argument])
+            elif opcode == DERIVATIVE:
+                stack.append(fp[argument])
+            else:
+                stack.append(argument)
+
+        if len(stack) == 0:
+            return None
+        return stack[-1]
+
+    # ---------------------------------------------------------------------------- #
+    def differentiate(self, x, f, fp, S, E):
+        ''' forward mode differentiation, for a single vector of free scalars S : returns the value of the equation and
+        its derivatives with respect to each S[i], stacked along the first axis (None if it does not depend on S) '''
+        n_constants = len(S)
+        stack = []
+        for opcode, argument in self.instructions:
+            if opcode == BINARY:
+                b, db = stack.pop()
+                a, da = stack[-1]
+                value = argument(a, b)
+                ndim = np.ndim(value)
+                if da is None and db is None:
+                    stack[-1] = (value, None)
+                else:
+                    stack[-1] = (value, binary_derivative(argument, a, b, value, lift(da, ndim), lift(db, ndim)))
+            elif opcode == UNARY:
+                a, da = stack[-1]
+                value = argument(a)
+                if da is None:
+                    stack[-1] = (value, None)
+                else:
+                    stack[-1] = (value, unary_derivative(argument, a, value, lift(da, np.ndim(value))))
+            elif opcode == SCALAR:
+                derivative = np.zeros(n_constants)
+                derivative[argument] = 1.
+                stack.append((S[argument], derivative))
+            elif opcode == VECTOR:
+                derivative = np.zeros((n_constants, 3))
+                derivative[argument:argument + 3] = E
+                stack.append((S[argument]*E[0] + S[argument + 1]*E[1] + S[argument + 2]*E[2], derivative))
+            elif opcode == VARIABLE:
+                if self.reshape_variables:
+                    stack.append((x[argument].reshape(-1, 1), None))
+                else:
+                    stack.append((x[argument], None))
+            elif opcode == TARGET:
+                stack.append((f[argument], None))
+            elif opcode == DERIVATIVE:
+                stack.append((fp[argument], None))
+            else:
+                stack.append((argument, None))
+
+        if len(stack) == 0:
+            return None, None
+        return stack[-1]
+
+# =============================== END CLASS: RPNProgram ================================ #
+
+# =============================== CLASS: BoundProgram ================================ #
+# An RPNProgram where the parts without free constants were computed once on some data (see bind) : called on other
+# data, it falls back to the full program
+
+class BoundProgram(RPNProgram):
+
+    def __init__(self, program, instructions, x, f, fp, values):
+        RPNProgram.__init__(self, instructions, program.calculus_mode, program.reshape_variables,
+                            program.scalar_numbers, program.v_numbers)
+        self.program = program
+        self.data = (x, f, fp)
+        self.values = values
+
+    # ---------------------------------------------------------------------------- #
+    def bound_to(self, x, f, fp):
+        return x is self.data[0] and f is self.data[1] and fp is self.data[2]
+
+    def __call__(self, x, f, fp, S, E, buffers = None):
+        if self.bound_to(x, f, fp):
+            return RPNProgram.__call__(self, x, f, fp, S, E, buffers)
+        return self.program(x, f, fp, S, E, buffers)
+
+    def differentiate(self, x, f, fp, S, E):
+        if self.bound_to(x, f, fp):
+            return RPNProgram.differentiate(self, x, f, fp, S, E)
+        return self.program.differentiate(x, f, fp, S, E)
+
+# =============================== END CLASS: BoundProgram ================================ #
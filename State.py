@@ -10,27 +10,440 @@
 # ================================= PREAMBLE ================================= #
 # Packages
 import copy
+import config
+from array import array
 # ============================================================================ #
 
 
+# ---------------------------------------------------------------------------- #
+# grammar of an rpn, updated one token at a time (see State.grammar), as a tuple :
+#   count : number of operands on the stack (1 : the rpn is one expression) ; vec_number : number of vectors in it ;
+#   types : stack of the types of the operands (0 scalar, 1 vector ; vectorial mode only) ; depths : stack of their
+#   number of nested functions ; a_number : number of free scalars (a vector counts for 3)
+# stacks are linked cells (top, rest) : pushing or popping never copies them
+empty_grammar = (0, 0, None, None, 0)
+
+def grammar_step(voc, calculus_mode, grammar, char):
+    count, vec_number, types, depths, a_number = grammar
+    arity = voc.token_arity[char]
+    if arity is None:  # halt, infinity
+        return grammar
+
+    # operands, nested functions and free scalars, as in Game.scalar_counter and Game.getnumberoffunctions
+    if arity == 0:
+        count += 1
+        depths = (0, depths)
+    elif arity == 1:
+        if depths is not None:
+            depths = (depths[0] + 1, depths[1])
+    else:
+        count -= 1
+        if depths is not None and depths[1] is not None:
+            depths = (max(depths[0], depths[1][0]), depths[1][1])
+    a_number += voc.token_scalars[char]
+
+    if calculus_mode != 'vectorial':
+        return count, vec_number, types, depths, a_number
+
+    # types of the operands, as in Game.from_rpn_to_critical_info
+    kind = voc.token_kind[char]
+    if arity == 0:
+        if voc.token_vector[char]:
+            vec_number += 1
+            types = (1, types)
+        else:
+            types = (0, types)
+
+    elif arity == 1:
+        if kind == 'norm':
+            vec_number -= 1
+            if types[0] == 1:
+                types = (0, types[1])
+            else:
+                print('fix bug: cant take the norm of a scalar')
+                raise ValueError
+        # if function like cos : stack doesnt change but for debug:
+        elif types[0] != 0:
+            print('cant take cosine of a vector (no pointwise operations allowed by choice)')
+            raise ValueError
+
+    else:  # arity 2
+        lasts = last_types(types, 2)
+        if kind == 'div':  # can only be [1, 0] : vector divided by scalar gives a vector:
+            if lasts == [1, 0]:
+                toadd = 1
+            elif lasts == [0, 0]:
+                toadd = 0
+            else:
+                print('fix bug: scalar cant be divided by vector; or vector by vector')
+                raise ValueError
+
+        elif kind == 'mult':
+            if lasts == [0, 0]:
+                toadd = 0
+            elif lasts == [0, 1] or lasts == [1, 0]:
+                toadd = 1
+            else:
+                print('fix bug: vectors cannot be multiplied')
+                raise ValueError
+
+        elif kind == 'plus' or kind == 'minus':
+            if lasts == [0, 0]:
+                toadd = 0
+            elif lasts == [0, 1] or lasts == [1, 0]:
+                print('fix bug: scalars cant be added to a vector')
+                raise ValueError
+            else:  # add two vectors : reduce n_vec one unit
+                toadd = 1
+                vec_number -= 1
+
+        elif kind == 'power':
+            if lasts == [0, 0]:
+                toadd = 0
+            else:
+                print('bug fixing : power not authorized here')
+                raise ValueError
+
+        elif kind == 'wedge':
+            vec_number -= 1
+            if lasts == [1, 1]:
+                toadd = 1
+            else:
+                print('bug fix : wedge not allowed')
+                raise ValueError
+
+        elif kind == 'dot':
+            vec_number -= 2
+            if lasts == [1, 1]:
+                toadd = 0
+            else:
+                print('bug : dot product not allowed')
+                raise ValueError
+
+        else:
+            print('bug : no type for', char)
+            raise ValueError
+
+        types = (toadd, types[1][1])
+
+    return count, vec_number, types, depths, a_number
+
+# type of the result of the operations, by the types of their operands (the other pairs are not allowed), as in
+# grammar_step. Scalar mode only has scalars
+unary_types = {'function': {0: 0}, 'norm': {1: 0}}
+binary_types = {'plus': {(0, 0): 0, (1, 1): 1}, 'minus': {(0, 0): 0, (1, 1): 1}, 'mult': {(0, 0): 0, (0, 1): 1, (1, 0): 1},
+                'div': {(0, 0): 0, (1, 0): 1}, 'power': {(0, 0): 0}, 'wedge': {(1, 1): 1}, 'dot': {(1, 1): 0}}
+
+def last_types(types, k):
+    # the k types on top of the stack, the top one last (fewer if the stack is shorter)
+    lasts = []
+    while types is not None and len(lasts) < k:
+        lasts.append(types[0])
+        types = types[1]
+    return lasts[::-1]
+
+def subtree_spans(voc, calculus_mode, rpn):
+    ''' one pass over an equation : for each token (up to the halt), where its subtree starts and the type of its value
+    (0 scalar, 1 vector ; always 0 in scalar mode). The subtree of the token i is rpn[starts[i]:i + 1] '''
+    starts = []
+    types = []
+    stack = []
+    vectorial = calculus_mode == 'vectorial'
+    for i, char in enumerate(rpn):
+        arity = voc.token_arity[char]
+        kind = voc.token_kind[char]
+        if kind == 'halt':
+            break
+        if arity is None or arity == 0:  # infinity is a leaf
+            starts.append(i)
+            types.append(1 if vectorial and voc.token_vector[char] else 0)
+        elif arity == 1:
+            operand = stack.pop()
+            starts.append(starts[operand])
+            types.append(unary_types[kind][types[operand]] if vectorial else 0)
+        else:
+            right, left = stack.pop(), stack.pop()
+            starts.append(starts[left])
+            types.append(binary_types[kind][(types[left], types[right])] if vectorial else 0)
+        stack.append(i)
+    return starts, types
+
+# ============================ CLASS: SubtreeStore ================================ #
+# every distinct subtree of the equations, as (last token, ids of its operands), is kept once under an id (hash consing) :
+# two subtrees are the same iff they have the same id. The formula and the key of an equation are computed once for the
+# whole population, and kept for the subtrees they were asked for only (the roots), not for every inner subtree.
+# One store per voc and per process (ids are not sent to the workers). Past config.subtree_store_size subtrees it starts
+# again empty, with a new generation number : ids are only valid within their generation (see State.nodes)
+
+class SubtreeStore:
+
+    def __init__(self, voc):
+        self.voc = voc
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        self.generation += 1
+        self.ids = {}
+        self.nodes = []
+        self.formulas = {}
+        self.keys = {}
+
+    # ---------------------------------------------------------------------------- #
+    def intern(self, node):
+        id = self.ids.get(node)
+        if id is None:
+            id = len(self.nodes)
+            self.ids[node] = id
+            self.nodes.append(node)
+        return id
+
+    def read(self, rpn):
+        # the ids of the subtrees left on the stack by the rpn, the first one first (None if operands are missing)
+        if len(self.nodes) > config.subtree_store_size:
+            self.clear()
+        token_arity, token_kind, ids = self.voc.token_arity, self.voc.token_kind, self.ids
+        stack = []
+        for char in rpn:
+            arity = token_arity[char]
+            if arity is None:
+                if token_kind[char] == 'halt':
+                    break
+                arity = 0  # infinity
+            if len(stack) < arity:
+                return None
+            if arity == 0:
+                node = (char,)
+            elif arity == 1:
+                node = (char, stack.pop())
+            else:
+                right = stack.pop()
+                node = (char, stack.pop(), right)
+            id = ids.get(node)
+            if id is None:
+                id = self.intern(node)
+            stack.append(id)
+        return stack
+
+    # ---------------------------------------------------------------------------- #
+    def rpn(self, id):
+        node = self.nodes[id]
+        rpn = []
+        for operand in node[1:]:
+            rpn += self.rpn(operand)
+        return rpn + [node[0]]
+
+    def formula(self, id):
+        # as State._convert_rpn_to_formula ; kept for the subtrees asked for
+        if id not in self.formulas:
+            self.formulas[id] = self.build_formula(id)
+        return self.formulas[id]
+
+    def build_formula(self, id):
+        # from the formulas of the operands
+        node = self.nodes[id]
+        char = self.voc.token_formula[node[0]]
+        kind = self.voc.token_kind[node[0]]
+        operands = [self.build_formula(operand) for operand in node[1:]]
+        if len(operands) == 0:
+            return char
+        elif kind == 'norm':
+            return char + operands[0] + ', axis = -1, keepdims = True)' #keepdims required for future (and batched) evaluation
+        elif len(operands) == 1:
+            return char + operands[0] + ')'
+        # avoid useless parenthesis
+        left, right = [operand if len(operand) == 1 else '(' + operand + ')' for operand in operands]
+        if kind == 'dot': #should read  'np.sum(a * b, axis=-1)' + keepdims necessary
+            return 'np.sum(' + left + '*' + right + ', axis = -1, keepdims = True)'
+        elif kind == 'wedge': # here its np.cross(a, b)
+            return char + left + ',' + right + ')'
+        return left + char + right
+
+    def canonical(self, id):
+        # (the rpn with commutative operands sorted, the operator if it is a + or * chain, the operands of that chain)
+        node = self.nodes[id]
+        char = node[0]
+        kind = self.voc.token_kind[char]
+        operands = [self.canonical(operand) for operand in node[1:]]
+        if len(operands) < 2:
+            return sum((operand[0] for operand in operands), ()) + (char,), None, None
+        elif kind == 'plus' or kind == 'mult':
+            chain = []
+            for operand in operands:
+                if operand[1] == char:
+                    chain += operand[2]
+                else:
+                    chain.append(operand[0])
+            chain.sort()
+            subtree = chain[0]
+            for operand in chain[1:]:
+                subtree = subtree + operand + (char,)
+            return subtree, char, chain
+        elif kind == 'dot':
+            left, right = sorted([operands[0][0], operands[1][0]])
+            return left + right + (char,), None, None
+        return operands[0][0] + operands[1][0] + (char,), None, None
+
+    def key(self, id):
+        # key of the fits of the equation id (see game_env.state_key) ; kept for the subtrees asked for
+        if id not in self.keys:
+            self.keys[id] = str(list(self.canonical(id)[0]))
+        return self.keys[id]
+
 # =============================== CLASS: State ================================ #
 # A class representing a state (n equations), as a list of strings or a vector in reverse polish notation (rpn)
+# The rpn is kept as an array of small ints, the formula is only built when first asked for : states are created for
+# every move, mutation and crossover, and sent to the workers by the thousands.
+# A move (see extended) does not copy the rpn : the new state points to its parent and keeps its last token only,
+# its rpn is read back along the parents the first time it is asked for.
+# The subtrees of the state are also known by their ids in the store of the voc (see SubtreeStore), when asked for
 
 class State:
-    # ---------------------------------------------------------------------------- #
-    # Constructs both the reverse polish vector representations and math formulas
+    __slots__ = ('voc', '_tokens', '_parent', 'last', 'length', 'calcuusmode', '_formulas', '_hash', '_grammar',
+                 '_nodes', '_spans', 'fitted_A', 'initial_A', 'fit_cost')
 
+    # ---------------------------------------------------------------------------- #
     def __init__(self, voc, state, calculus_mode):
 
         self.voc = voc
-        self.reversepolish = state
+        self._tokens = array('h', state)
+        self._parent = None
+        self.last = self._tokens[-1] if len(self._tokens) > 0 else None
+        self.length = len(self._tokens)
         self.calcuusmode = calculus_mode
-        self.formulas = self._convert_rpn_to_formula()
+        self._formulas = None
+        self._hash = None
+        self._grammar = None
+        self._nodes = None
+        self._spans = None
+        # constants found by the last fit of this state, and the warm start inherited from its parents (see generate_offsprings)
+        self.fitted_A = None
+        self.initial_A = None
+        # duration of the last fit (see run_one_target.evalme)
+        self.fit_cost = 0.
+
+    # ---------------------------------------------------------------------------- #
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            # the tokens added since the closest parent that has its rpn
+            moves = []
+            state = self
+            while state._tokens is None:
+                moves.append(state.last)
+                state = state._parent
+            moves.reverse()
+            self._tokens = state._tokens + array('h', moves)
+            self._parent = None
+        return self._tokens
+
+    @property
+    def reversepolish(self):
+        # a new list : changing it does not change the state
+        return self.tokens.tolist()
+
+    @property
+    def formulas(self):
+        if self._formulas is None:
+            self._formulas = self._convert_rpn_to_formula()
+        return self._formulas
+
+    @property
+    def grammar(self):
+        # see grammar_step : read once over the rpn, then carried from a state to the next by extended
+        if self._grammar is None:
+            grammar = empty_grammar
+            for char in self.tokens:
+                grammar = grammar_step(self.voc, self.calcuusmode, grammar, char)
+            self._grammar = grammar
+        return self._grammar
+
+    @property
+    def spans(self):
+        # see subtree_spans : read once, the parents of the pool give many offsprings (see generate_offsprings)
+        if self._spans is None:
+            self._spans = subtree_spans(self.voc, self.calcuusmode, self.tokens)
+        return self._spans
+
+    @property
+    def nodes(self):
+        # the ids of the subtrees left on the stack by the rpn (one for a whole equation) in the store of the voc, to be
+        # used right away (see SubtreeStore.clear) ; empty if the rpn misses operands
+        store = self.voc.subtrees
+        if self._nodes is None or self._nodes[0] != store.generation:
+            ids = store.read(self.tokens)
+            self._nodes = (store.generation, tuple(ids) if ids is not None else ())
+        return self._nodes[1]
+
+    def extended(self, char):
+        # the state with one more token (a move of game_env.Game) : nothing is copied, the grammar is updated from this one
+        char = int(char)
+        newstate = State.__new__(State)
+        newstate.voc = self.voc
+        newstate._tokens = None
+        newstate._parent = self
+        newstate.last = char
+        newstate.length = self.length + 1
+        newstate.calcuusmode = self.calcuusmode
+        newstate._formulas = None
+        newstate._hash = None
+        newstate._grammar = grammar_step(self.voc, self.calcuusmode, self.grammar, char)
+        newstate._nodes = None
+        newstate._spans = None
+        newstate.fitted_A = None
+        newstate.initial_A = None
+        newstate.fit_cost = 0.
+        return newstate
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.calcuusmode, self.tokens.tobytes()))
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, State) and self.calcuusmode == other.calcuusmode and self.length == other.length \
+               and self.tokens == other.tokens
+
+    # ---------------------------------------------------------------------------- #
+    # copies and pickles share the voc (the rpn is all that changes from one state to another)
+    def __deepcopy__(self, memo):
+        newstate = State(self.voc, self.tokens, self.calcuusmode)
+        newstate._formulas = self._formulas
+        newstate._grammar = self._grammar
+        newstate._nodes = self._nodes
+        newstate._spans = self._spans
+        newstate.fitted_A = copy.deepcopy(self.fitted_A, memo)
+        newstate.initial_A = copy.deepcopy(self.initial_A, memo)
+        newstate.fit_cost = self.fit_cost
+        return newstate
+
+    def __getstate__(self):
+        return {'voc': self.voc, 'tokens': self.tokens, 'calcuusmode': self.calcuusmode, '_formulas': self._formulas,
+                'fitted_A': self.fitted_A, 'initial_A': self.initial_A, 'fit_cost': self.fit_cost}
+
+    def __setstate__(self, state):
+        # states pickled before (in saved qd pools) have a reversepolish list and their formulas
+        if 'reversepolish' in state:
+            state = dict(state, tokens=array('h', state['reversepolish']), _formulas=state.get('formulas'))
+        self.voc = state['voc']
+        self._tokens = state['tokens']
+        self._parent = None
+        self.last = self._tokens[-1] if len(self._tokens) > 0 else None
+        self.length = len(self._tokens)
+        self.calcuusmode = state['calcuusmode']
+        self._formulas = state.get('_formulas')
+        self._hash = None
+        self._grammar = None
+        self._nodes = None
+        self._spans = None
+        self.fitted_A = state.get('fitted_A')
+        self.initial_A = state.get('initial_A')
+        self.fit_cost = state.get('fit_cost', 0.)
 
     # ---------------------------------------------------------------------------- #
     def one_simplif(self):
         # read the rpn vector and apply one simplification according to simplification rules
-        rpn = copy.deepcopy(self.reversepolish)
+        rpn = self.reversepolish
         change = 0
         index = 0
         while index < len(rpn) and change == 0 :
@@ -48,135 +461,12 @@ class State:
 
     # ---------------------------------------------------------------------------- #
     def _convert_rpn_to_formula(self):
-        #read the RPN from left to right and stack the corresponding string
-        stack = []
-
-        # ------------- vectorial case
-        if self.calcuusmode == 'vectorial':
-            for number in self.reversepolish:
-                char = self.voc.numbers_to_formula_dict[str(number)]
-                if number in self.voc.arity0symbols:
-                    stack.append(char)
-
-                elif number in self.voc.arity1_novec:
-                    sentence = stack[-1]
-                    newstack = char + sentence + ')' #add parenthesis!
-                    if len(stack) == 1:
-                        stack = [newstack]
-                    else:
-                        stack = stack[:-1] + [newstack]
-
-                elif number in self.voc.norm_number:
-                    sentence = stack[-1]
-                    newstack = char + sentence + ', axis = 1).reshape(SIZE,1)' #reshape required for future evaluation
-                    if len(stack) == 1:
-                        stack = [newstack]
-                    else:
-                        stack = stack[:-1] + [newstack]
-
-                elif number in self.voc.arity2novec:
-                    if len(stack[-2]) == 1:  # avoid useless parenthesis
-                        addleft = stack[-2]
-                    else:
-                        addleft = '(' + stack[-2] + ')'
-
-                    if len(stack[-1]) == 1:
-                        addright = stack[-1]
-                    else:
-                        addright = '(' + stack[-1] + ')'
-
-                    newstack = stack[:-2] + [addleft + char + addright]
-                    stack = newstack
-
-                elif number in self.voc.dot_number: #should read  'np.sum(a * b, axis=1)' + reshape necessary
-                    if len(stack[-2]) == 1:
-                        addleft = stack[-2]
-                    else:
-                        addleft = '(' + stack[-2] + ')'
-
-                    if len(stack[-1]) == 1:
-                        addright = stack[-1]
-                    else:
-                        addright = '(' + stack[-1] + ')'
-
-                    newstack = stack[:-2] + ['np.sum(' + addleft + '*' + addright+ ', axis = 1).reshape(SIZE,1)']
-                    stack = newstack
-
-                elif number in self.voc.wedge_number: # here its np.cross(a, b)
-                    if len(stack[-2]) == 1:
-                        addleft = stack[-2]
-                    else:
-                        addleft = '(' + stack[-2] + ')'
-
-                    if len(stack[-1]) == 1:
-                        addright = stack[-1]
-                    else:
-                        addright = '(' + stack[-1] + ')'
-
-                    newstack = stack[:-2] + [char+addleft+','+ addright+ ')']
-                    stack = newstack
-
-                elif number in self.voc.true_zero_number:
-                    stack.append(char)
-
-                elif number in self.voc.neutral_element:
-                    stack.append(char)
-
-                elif number in self.voc.infinite_number:
-                    stack.append(char)
-
-            # might happen if first symbol is 1 ('halt')
-            if len(stack) == 0:
-                formula = ''
-            else:
-                formula = stack[0]
-
-            return formula
-
-        # ------------- scalar case
-        else:
-            for number in self.reversepolish:
-                char = self.voc.numbers_to_formula_dict[str(number)]
-                if number in self.voc.arity0symbols:
-                    stack.append(char)
-
-                elif number in self.voc.arity1symbols:
-                    sentence = stack[-1]
-                    newstack = char + sentence + ')'
-                    if len(stack) == 1:
-                        stack = [newstack]
-                    else:
-                        stack = stack[:-1] + [newstack]
-
-                elif number in self.voc.arity2symbols:
-                    if len(stack[-2]) == 1:
-                        addleft = stack[-2]
-                    else:
-                        addleft = '(' + stack[-2] + ')'
-
-                    if len(stack[-1]) == 1:
-                        addright = stack[-1]
-                    else:
-                        addright = '(' + stack[-1] + ')'
-
-                    newstack = stack[:-2] + [addleft + char + addright]
-                    stack = newstack
-
-                elif number in self.voc.true_zero_number:
-                    stack.append(char)
-
-                elif number in self.voc.neutral_element:
-                    stack.append(char)
-
-                elif number in self.voc.infinite_number:
-                    stack.append(char)
-
-            if len(stack) == 0:
-                formula = ''
-            else:
-                formula = stack[0]
-
-            return formula
+        # the formula of the first expression of the rpn (see SubtreeStore.formula) : subtrees shared by several states
+        # are written once
+        nodes = self.nodes
+        if len(nodes) == 0:  # might happen if first symbol is 1 ('halt')
+            return ''
+        return self.voc.subtrees.formula(nodes[0])
 
 # =============================== END CLASS: State ================================ #
 
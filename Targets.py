@@ -16,6 +16,7 @@ import Simplification_rules
 import pickle
 import config
 from scipy import interpolate
+from State import SubtreeStore
 
 # ============================================================================ #
 
@@ -197,9 +198,85 @@ class Voc():
                                           self.all_targets_name, u, self.calculus_mode, self.look_for, self.expert_knowledge)
 
 
+        # what each token is, read by its number (see build_token_tables)
+        self.build_token_tables()
+
+        # allowed moves of game_env.Game, by grammar state, and number of ways to complete an equation (see
+        # game_env.completions) : filled as they are needed
+        self.move_table = {}
+        self.completion_table = {}
+        # the subtrees of all the equations (see State.SubtreeStore)
+        self.subtrees = SubtreeStore(self)
+
         #todo redo later
         #self.mysimplificationrules, self.maxrulesize = self.create_dic_of_simplifs()
 
+    # the tables are not sent to the workers (each one fills its own)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['move_table'] = {}
+        state['completion_table'] = {}
+        del state['subtrees']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'move_table' not in state:
+            self.move_table = {}
+        if 'completion_table' not in state:
+            self.completion_table = {}
+        self.subtrees = SubtreeStore(self)
+        if 'token_kind' not in state:
+            self.build_token_tables()
+
+    # ---------------------------------------------------------------------------- #
+    def build_token_tables(self):
+        # lists indexed by the token number, so that the rpn is read without membership tests on the symbol tuples :
+        #   token_formula : its piece of formula ; token_arity : 0, 1 or 2 (None for halt and infinity) ;
+        #   token_kind : 'halt', 'infinity', 'zero', 'neutral', 'number', 'variable', 'target', 'derivative', 'operand'
+        #   (other arity 0), 'function', 'norm', 'plus', 'minus', 'mult', 'div', 'power', 'dot', 'wedge' ;
+        #   token_vector : 1 for a vector, 0 for a scalar (what an arity 0 token pushes) ;
+        #   token_scalars : number of free scalars it brings (a vector of free scalars counts for 3)
+        size = max(int(number) for number in self.numbers_to_formula_dict) + 1
+        self.token_formula = [None] * size
+        self.token_arity = [None] * size
+        self.token_kind = [None] * size
+        self.token_vector = [0] * size
+        self.token_scalars = [0] * size
+
+        for number, formula in self.numbers_to_formula_dict.items():
+            self.token_formula[int(number)] = formula
+
+        kinds = [(self.terminalsymbol, 'halt', None), (self.infinite_number, 'infinity', None),
+                 (self.true_zero_number, 'zero', 0), (self.neutral_element, 'neutral', 0),
+                 (self.arity0symbols, 'operand', 0), (self.var_numbers, 'variable', 0),
+                 (self.targetfunction_number, 'target', 0), (self.first_der_number, 'derivative', 0),
+                 (self.pure_numbers, 'number', 0), (self.arity1symbols, 'function', 1), (self.norm_number, 'norm', 1),
+                 (self.arity2symbols, 'power', 2), (self.plusnumber, 'plus', 2), (self.minusnumber, 'minus', 2),
+                 (self.multnumber, 'mult', 2), (self.divnumber, 'div', 2), (self.dot_number, 'dot', 2),
+                 (self.wedge_number, 'wedge', 2)]
+        # later entries refine the earlier ones ; the arity 2 symbols left as 'power' are checked below
+        for numbers, kind, arity in kinds:
+            for number in numbers:
+                if number is not None:
+                    self.token_kind[number] = kind
+                    self.token_arity[number] = arity
+
+        for number in self.arity2symbols:
+            if self.token_kind[number] == 'power' and number not in self.power_number:
+                print('bug : no kind for the operator', number, self.token_formula[number])
+                raise ValueError
+
+        for number in self.arity0_vec:
+            self.token_vector[number] = 1
+        if self.calculus_mode == 'vectorial':
+            self.token_scalars[self.pure_numbers[0]] = 1
+            if len(self.pure_numbers) > 1:
+                self.token_scalars[self.pure_numbers[1]] = 3
+        else:
+            for number in self.pure_numbers:
+                self.token_scalars[number] = 1
+
     def replacemotor(self, toreplace,replaceby, k):
         firstlist = []
         secondlist = []
@@ -82,6 +82,77 @@ max_A_number = 1200
 #after some tests, its better to use both the distance cost AND the derivative cost
 usederivativecost = 0  #or 0
 
+# -------------------- evaluation related -------------------------- #
+# how many compiled formulas each process keeps (LRU) : the same equation is often fitted again in later iterations
+formula_cache_size = 10000
+# 'rpn' : equations are evaluated by a stack machine reading the rpn ; 'formula' : eval of the renamed formula string
+evaluation_engine = 'rpn'
+# cma-es asks for a whole population and evaluates it in one numpy pass, instead of one candidate per call
+batched_cmaes = True
+# the parts of an equation without free constants are computed once per fit, not at each objective call
+precompute_constant_free = True
+# the rpn programs write into work arrays kept for the whole fit, instead of new arrays at each objective call
+preallocated_buffers = True
+# 'numpy' : the rpn program broadcast over the cma population ; 'numba' : one jit compiled loop per equation, without
+# intermediate arrays (scalar mode, from jit_min_points data points ; back to numpy if numba is not installed)
+evaluation_backend = 'numpy'
+jit_min_points = 100000
+# constants entering linearly (additive terms, coefficients of the top level sum) are solved by least squares
+variable_projection = True
+# after cma-es, polish the constants by levenberg-marquardt (jacobian by forward mode differentiation of the rpn)
+gradient_refinement = True
+least_squares_max_nfev = 200
+# equations with at most this many free scalars are fitted by levenberg-marquardt alone, from a few random starts
+least_squares_max_constants = 2
+least_squares_restarts = 4
+# offsprings start the fit from the constants of their parents, with a small cma-es sigma
+warm_start = True
+warm_start_sigma = 0.3
+# successive halving : before their full fit, new states are fitted on growing fractions of the data (of at least
+# racing_min_points points) with at most racing_max_evaluations cma-es evaluations, and dropped if their rms is above
+# racing_margin times the rms of the elite of their bin
+fitness_racing = True
+racing_fractions = [0.05, 0.25]
+racing_min_points = 50
+racing_max_evaluations = 1000
+racing_margin = 1.5
+# before the fit, reject the equations that are not finite on the data : nan in their parts without constants, or
+# not finite for any of prescreen_samples random constants (in +-1 or +-prescreen_scale) on prescreen_points points
+prescreen = True
+prescreen_samples = 64
+prescreen_scale = 5.
+prescreen_points = 10
+# equations already fitted in an earlier iteration are not fitted again : their best result is reused, except for the
+# refit_fraction most promising ones, refitted from their best constants so far
+fitness_memo = True
+refit_fraction = 0.05
+# fits are also kept on disk (sqlite, in the results folder) and reused by later runs on the same data
+fitness_store = True
+fitness_store_file = 'fitness_store.sqlite'
+# equations that give the same values as an equation already fitted (and not longer), on fingerprint_points points
+# and for two sets of pseudo random constants (drawn from fingerprint_seed), are not fitted
+semantic_dedup = True
+fingerprint_points = 20
+fingerprint_seed = 1234
+fingerprint_digits = 9
+# random equations of the initial pool and of the refills : 'moves' : token by token, each one uniformly among the
+# allowed moves (with config.force_terminal) ; 'uniform' : their size is drawn uniformly among the possible ones, then
+# the equation uniformly among all those of that size (see game_env.uniform_randomstates). 'uniform' gives more long
+# equations than 'moves' : it changes the sizes in the initial pool and the refills
+random_equations = 'moves'
+# 'moves' only : the equations are drawn all at once in the main process (see game_env.random_rpn_matrix), instead of
+# one by one (by the workers for the initial pool). Same distribution, but another use of the random generators : a
+# seeded run does not give the same equations as before
+bulk_random_equations = False
+# every distinct subtree is kept once (see State.SubtreeStore) : at most this many, then the store starts again (about
+# 12 MB per 50000 subtrees, with the formulas and keys of the equations)
+subtree_store_size = 50000
+# each process keeps the values of the parts of equations without free constants, on the data of the fits (LRU of at
+# most subtree_value_cache_bytes) : precompute_constant_free then finds most of them already computed. The budget is
+# per process : the workers together use up to cpus times as much (800 MB with cpus = 40)
+subtree_value_cache = True
+subtree_value_cache_bytes = 20000000
+
 #misc
 uselocal = False
 cpus = 40
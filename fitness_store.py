@@ -0,0 +1,90 @@
+#  ======================== CMA-Based Symbolic Regressor ========================== #
+# Project:          Symbolic regression for physics
+# Name:             fitness_store.py
+# Authors:          Jean-Philippe Bruneton
+# Date:             2020
+# License:          BSD 3-Clause License
+# ============================================================================ #
+
+
+# ================================= PREAMBLE ================================= #
+# Packages
+import numpy as np
+import config
+import sqlite3
+import hashlib
+import json
+import time
+import Evaluate_rpn
+
+# ============================================================================ #
+# the fits of all equations, kept on disk (sqlite) across runs and targets.
+# A fit is keyed by (hash of the data and of the voc, look_for, equation key) : the same rpn on other data,
+# or with another vocabulary (integers A vs free scalars), is another fit. Equations with the same key (see
+# game_env.state_key) share their fit : the rpn kept is the one the constants were fitted for
+
+def dataset_hash(train_targets, u, voc):
+    # all targets enter : the others (and their derivatives) can appear in the equations of target u
+    digest = hashlib.sha1()
+    for target in train_targets:
+        for array in list(target[1]) + [target[2], target[3], target[4]]:
+            if array is not None:
+                array = np.ascontiguousarray(array, dtype=float)
+                digest.update(str(array.shape).encode())
+                digest.update(array.tobytes())
+    # so is the way rms (and the constants) are computed
+    digest.update(str([u, voc.modescalar, Evaluate_rpn.voc_signature(voc), config.usederivativecost, config.loglog,
+                       config.specialgal, config.parsimony, config.parsimony_cost]).encode())
+    return digest.hexdigest()
+
+# ---------------------------------------------------------------------------- #
+def store_path():
+    if config.uselocal:
+        return 'results/' + config.fitness_store_file
+    else:
+        return '/home/user/results/' + config.fitness_store_file
+
+# ============================ CLASS: FitnessStore ================================ #
+class FitnessStore:
+
+    def __init__(self, train_targets, u, voc, look_for, path = None):
+        self.dataset = dataset_hash(train_targets, u, voc)
+        self.look_for = str(look_for)
+        self.connection = sqlite3.connect(store_path() if path is None else path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fits (dataset TEXT, look_for TEXT, equation TEXT, '
+                                'rpn TEXT, rms REAL, constants TEXT, scalar_numbers INTEGER, cost REAL, n_fits INTEGER, '
+                                'created REAL, updated REAL, PRIMARY KEY (dataset, look_for, equation))')
+        self.connection.commit()
+
+    # ---------------------------------------------------------------------------- #
+    def load(self):
+        # all the fits already done on these data : {equation key : [rms, rpn, constants, scalar_numbers]}
+        # (same layout as the results of run_one_target.evalme, with the rpn instead of the state)
+        fits = {}
+        rows = self.connection.execute('SELECT equation, rpn, rms, constants, scalar_numbers FROM fits '
+                                       'WHERE dataset = ? AND look_for = ?', (self.dataset, self.look_for))
+        for equation, rpn, rms, constants, scalar_numbers in rows:
+            fits.update({equation: [rms, json.loads(rpn), json.loads(constants), scalar_numbers]})
+        return fits
+
+    # ---------------------------------------------------------------------------- #
+    def write(self, fits):
+        # fits : list of [equation key, rpn, rms, constants, scalar_numbers, cost in seconds].
+        # Only improves the stored rms, but the cost of every fit is accumulated
+        now = time.time()
+        rows = []
+        for equation, rpn, rms, constants, scalar_numbers, cost in fits:
+            if rms is None or np.isnan(rms):
+                rms = 100000000
+            rows.append((self.dataset, self.look_for, equation, json.dumps([int(char) for char in rpn]), float(rms),
+                         json.dumps(np.asarray(constants, dtype=float).tolist()), int(scalar_numbers),
+                         float(cost), now, now))
+
+        self.connection.executemany('INSERT INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?) '
+                                    'ON CONFLICT (dataset, look_for, equation) DO UPDATE SET '
+                                    'rpn = CASE WHEN excluded.rms < rms THEN excluded.rpn ELSE rpn END, '
+                                    'constants = CASE WHEN excluded.rms < rms THEN excluded.constants ELSE constants END, '
+                                    'scalar_numbers = CASE WHEN excluded.rms < rms THEN excluded.scalar_numbers ELSE scalar_numbers END, '
+                                    'rms = MIN(rms, excluded.rms), cost = cost + excluded.cost, n_fits = n_fits + 1, '
+                                    'updated = excluded.updated', rows)
+        self.connection.commit()
@@ -8,13 +8,14 @@
 
 # ================================= PREAMBLE ================================= #
 # Packages
-from State import State
+from State import State, last_types, unary_types, binary_types
 import config
 from Evaluate_fit import Evaluatefit
 from AST import AST, Node
 import numpy as np
 import copy
 import random
+import bisect
 # =============================== CLASS: Game ================================ #
 
 class Game:
@@ -34,423 +35,322 @@ class Game:
     # ---------------------------------------------------------------------------- #
     def scalar_counter(self):
         # says if the current equation is a number (or a vector of numbers!) or not (if counter == 1)
-        counter = 0
-        for char in self.state.reversepolish:
-            # infinity doesnt count as a scalar since we discard such equations from the start; see elsewhere
-            if char in self.voc.arity0symbols or char in self.voc.neutral_element or char in self.voc.true_zero_number:
-                counter += 1
-            elif char in self.voc.arity2symbols:
-                counter -= 1
-        return counter
+        # infinity doesnt count as a scalar since we discard such equations from the start; see elsewhere
+        return self.state.grammar[0]
 
     # ------------------------------------------------- #
     def from_rpn_to_critical_info(self):
         # given an equation, returns if it can be terminated or not, the number of vectors (A_vec wedge A_vec is only one vector, etc)
-        # and the last two entries type with 0 : scalar, 1 : vector
-        can_be_terminated = 0
-        for char in self.state.reversepolish:
-            if char in self.voc.arity0symbols or char in self.voc.neutral_element or char in self.voc.true_zero_number:
-                can_be_terminated += 1
-            elif char in self.voc.arity2symbols:
-                can_be_terminated -= 1
-            else:
-                pass
+        # and the last entries type with 0 : scalar, 1 : vector. Only the last three types are ever looked at : a longer
+        # stack is returned as these three after a None
+        can_be_terminated, vec_number, types, _, _ = self.state.grammar
+        stack = last_types(types, 4)
+        if len(stack) == 4:
+            stack[0] = None
+        return can_be_terminated, vec_number, stack
 
-        vec_number = 0 #number of vectors in expression
-        stack = []  # this stores the type of the two last entries
 
-        for char in self.state.reversepolish:
-            if char in self.voc.terminalsymbol:
-                pass
+    # ---------------------------------------------------------------------------- #
+    def allowedmoves_vectorial(self):
+        # determines which character can be added to the rpn in vectorial mode, under the constraint that the equation
+        # must eventually terminate with a maximal size. The moves only depend on a few numbers (see vectorial_moves) :
+        # they are computed once for each of their values, and kept in the table of the voc
+        allowedchars, can_force_terminal = self.table_moves()
 
-            # arity 0
-            elif char in self.voc.arity0symbols:
-                if char in self.voc.arity0_vec:
-                    vec_number += 1
-                    stack.append(1)
-                else:
-                    stack.append(0)
-
-            # arity 1
-            elif char in self.voc.arity1symbols:
-                if char in self.voc.norm_number:
-                    vec_number -= 1
-                    if stack[-1] == 1:
-                        stack = stack[:-1] + [0]
-                    else:
-                        print('fix bug: cant take the norm of a scalar')
-                        raise ValueError
+        # option that counter the tendency to create too long expresions : enforce terminal state now and then:
+        if can_force_terminal:
+            if random.random() < config.force_terminal:
+                allowedchars = self.voc.terminalsymbol
 
-                # if function like cos : stack doesnt change but for debug:
-                else:
-                    if stack[-1] != 0:
-                        print('cant take cosine of a vector (no pointwise operations allowed by choice)')
-                        raise ValueError
+        return allowedchars
 
-            else:  # arity 2
-                lasts = stack[-2:]
+    # ---------------------------------------------------------------------------- #
+    def table_moves(self):
+        # the allowed moves, read in the table of the voc (filled by vectorial_moves or scalar_moves), and whether a
+        # terminal symbol may be forced instead (vectorial mode only)
+        current_state_size = self.state.length
+        space_left = self.maxL - current_state_size
 
-                if char in self.voc.divnumber:  # can only be [1, 0] : vector divided by scalar gives a vector:
-                    if lasts == [1, 0]:
-                        toadd = [1]
-                    elif lasts == [0, 0]:
-                        toadd = [0]
-                    else:
-                        print('fix bug: scalar cant be divided by vector; or vector by vector')
-                        raise ValueError
+        # init : we go upward in the tree so we must start with a scalar
+        if current_state_size == 0:
+            return self.voc.arity0symbols, False #start either with a vec or a scalar
 
-                elif char in self.voc.multnumber:
-                    if lasts == [0, 0]:
-                        toadd = [0]
-                    elif lasts == [0, 1] or lasts == [1, 0]:
-                        toadd = [1]
-                    else:
-                        print('fix bug: vectors cannot be multiplied')
-                        raise ValueError
+        # check if already terminated
+        last_kind = self.voc.token_kind[self.state.last]
+        if last_kind == 'halt' or space_left == 0:
+            return (), False
 
-                elif char in self.voc.plusnumber or char in self.voc.minusnumber:
-                    if lasts == [0,0]:
-                        toadd = [0]
-                    elif lasts == [0,1] or lasts == [1,0]:
-                        print('fix bug: scalars cant be added to a vector')
-                        raise ValueError
-                    else: # add two vectors : reduce n_vec one unit
-                        toadd = [1]
-                        vec_number -=1
+        if self.calculus_mode == 'vectorial':
+            can_be_terminated, vec_number, stack = self.from_rpn_to_critical_info()
+            key = ('vectorial', space_left, can_be_terminated, vec_number, tuple(stack), self.getnumberoffunctions() < config.MAX_DEPTH)
+            if key not in self.voc.move_table:
+                self.voc.move_table[key] = self.vectorial_moves(*key[1:])
+            return self.voc.move_table[key]
+
+        key = ('scalar', space_left, self.scalar_counter(), last_kind == 'number',
+               self.state.grammar[4] < config.max_A_number, self.getnumberoffunctions() < config.MAX_DEPTH)
+        if key not in self.voc.move_table:
+            self.voc.move_table[key] = self.scalar_moves(*key[1:])
+        return self.voc.move_table[key], False
 
-                elif char in self.voc.power_number:
-                    if lasts == [0, 0]:
-                        toadd = [0]
-                    else:
-                        print('bug fixing : power not authorized here')
-                        raise ValueError
+    # ---------------------------------------------------------------------------- #
+    def vectorial_moves(self, space_left, can_be_terminated, vec_number, stack, functions_allowed):
+        # the allowed moves of allowedmoves_vectorial, and whether a terminal symbol may be forced instead
+        stack = list(stack)
+        info = [can_be_terminated, vec_number, stack]
+        can_force_terminal = False
+
+        if can_be_terminated == 0:
+            print('bug : should not happen at all here 1', info)
+            raise ValueError
 
-                elif char in self.voc.wedge_number:
-                    vec_number -= 1
-                    if lasts == [1, 1]:
-                        toadd = [1]
-                    else:
-                        print('bug fix : wedge not allowed')
-                        raise ValueError
+        # First case : one character left -----------
+        if space_left == 1:
+            if can_be_terminated == 1: # must terminate
+                allowedchars = self.voc.terminalsymbol
+                if vec_number !=1:
+                    print('this shd not happen otherwise we get a non vectorial expression 2', info)
+                    raise ValueError
 
-                elif char in self.voc.dot_number:
-                    vec_number -= 2
-                    if lasts == [1, 1]:
-                        toadd = [0]
+            elif can_be_terminated == 2:
+                if vec_number == 1: # two numbers one vec one scalar
+                    if stack[-2:] == [0, 1]:
+                        allowedchars = self.voc.multnumber
+                    elif stack[-2:] == [1, 0]:
+                        allowedchars = self.voc.multnumber + self.voc.divnumber
                     else:
-                        print('bug : dot product not allowed')
+                        print('debug shd not happen 3', info)
                         raise ValueError
 
-                # update stack
-                stack = stack[:-2] + toadd
+                elif vec_number ==2:
+                    if stack[-2:] == [1, 1]:  # A wedge A, A+A or A -A
+                        allowedchars = self.voc.wedge_number + self.voc.plusnumber + self.voc.minusnumber
 
-        return can_be_terminated, vec_number, stack
+            else:
+                print('bug : cant terminate 4', info)
+                raise ValueError
+
+        # Case space left is 2 -------------
+        elif space_left == 2 :
+
+            if can_be_terminated == 1:
+                if vec_number == 0: #must add a vector
+                    allowedchars = self.voc.arity0_vec
+                elif vec_number==1:
+                    allowedchars = self.voc.terminalsymbol
+                    allowedchars += self.voc.arity0symbols
+                else:
+                    print('must not happen 5', info)
+                    raise ValueError
 
+            elif can_be_terminated == 2: #operator required
+                if vec_number == 0:
+                    print('must not happen 6', info)
+                    raise ValueError
 
-    # ---------------------------------------------------------------------------- #
-    def allowedmoves_vectorial(self):
-        # determines which character can be added to the rpn in vectorial mode, under the constraint that the equation
-        # must eventually terminate with a maximal size
-        current_state_size = len(self.state.reversepolish)
-        space_left = self.maxL - current_state_size
-        current_A_number = sum([1 for x in self.state.reversepolish if x == self.voc.pure_numbers[0]])
-        current_A_number += sum([3 for x in self.state.reversepolish if x == self.voc.pure_numbers[1]]) #this assumes 3D vectors
+                elif vec_number == 1:
+                    if stack[-2:] == [0,1]:
+                        allowedchars = self.voc.multnumber
+                    elif stack[-2:] == [1, 0]:
+                        allowedchars = self.voc.multnumber + self.voc.divnumber
+                    else:
+                        print('bug fixing 7', info)
+                        raise ValueError
 
-        # init : we go upward in the tree so we must start with a scalar
-        if current_state_size == 0:
-            allowedchars = self.voc.arity0symbols #start either with a vec or a scalar
+                elif vec_number == 2: #op required and decrease vec number, thus:
+                    allowedchars = self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
 
-        else:
-            # check if already terminated
-            if self.state.reversepolish[-1] in self.voc.terminalsymbol or space_left == 0:
-                allowedchars = []
-            else:
-                can_be_terminated, vec_number, stack = self.from_rpn_to_critical_info()
-                info = [self.state.formulas, can_be_terminated, vec_number, stack]
+                else:
+                    print('bug fixing 8', info)
+                    raise ValueError
 
-                if can_be_terminated == 0:
-                    print('bug : should not happen at all here 1', info)
+            elif can_be_terminated == 3: #two operators required
+                if vec_number == 0:
+                    print('must not happen 9', info)
                     raise ValueError
+                elif vec_number == 1:
+                    if stack[-3:] == [0,0,1]:
+                        allowedchars = self.voc.multnumber
+                    elif stack == [0,1,0]:
+                        allowedchars = self.voc.multnumber + self.voc.divnumber
+                    elif stack == [1,0,0]:
+                        allowedchars = self.voc.arity2novec
+                    else:
+                        print('bugfixing10', info)
+                        raise ValueError
+                elif vec_number == 2: #2 op required and minus one vector:
+                    if stack[-3:] == [0,1,1]:
+                        allowedchars = self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
+                    elif stack == [1,0,1]:
+                        allowedchars = self.voc.multnumber
+                    elif stack == [1,1,0]:
+                        allowedchars = self.voc.multnumber + self.voc.divnumber
+                    else:
+                        print('bugfixing11', info)
+                        raise ValueError
 
-                # First case : one character left -----------
-                if space_left == 1:
-                    if can_be_terminated == 1: # must terminate
-                        allowedchars = self.voc.terminalsymbol
-                        if vec_number !=1:
-                            print('this shd not happen otherwise we get a non vectorial expression 2', info)
-                            raise ValueError
-
-                    elif can_be_terminated == 2:
-                        if vec_number == 1: # two numbers one vec one scalar
-                            if stack[-2:] == [0, 1]:
-                                allowedchars = self.voc.multnumber
-                            elif stack[-2:] == [1, 0]:
-                                allowedchars = self.voc.multnumber + self.voc.divnumber
-                            else:
-                                print('debug shd not happen 3', info)
-                                raise ValueError
-
-                        elif vec_number ==2:
-                            if stack[-2:] == [1, 1]:  # A wedge A, A+A or A -A
-                                allowedchars = self.voc.wedge_number + self.voc.plusnumber + self.voc.minusnumber
+                elif vec_number == 3: # case stack 1 1 1
+                    allowedchars = self.voc.dot_number + self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
+                else:
+                    print('bugfixing11', info)
+                    raise ValueError
 
+        # General case-------------
+        elif space_left >= 3:
+            t = can_be_terminated - 1  # this equals to the number of operators required
+            nu = vec_number - 1  # number of extra vectors : if >=1 : must reduce the number of vectors
+            p = space_left
+            allowedchars = []
+            if nu == 0 and t == 0:
+                allowedchars = self.voc.terminalsymbol
+
+            if p < t:
+                print('impossible to terminate must not happen 12', info)
+                raise ValueError
+
+            elif p == t: # t operators required in t space left : only operators allowed here
+                if nu == -1:
+                    print('impossible to terminate with a vec expression  13: shd never happen', info)
+                    raise ValueError
+                elif nu >= 0:
+                    lasts = stack[-2:]
+                    if lasts == [0,0]:
+                        allowedchars += self.voc.arity2novec
+                    elif lasts == [0,1]:
+                        allowedchars += self.voc.multnumber
+                    elif lasts == [1, 0]:
+                        allowedchars += self.voc.multnumber + self.voc.divnumber
+                    elif lasts == [1,1] and nu <=1:
+                        allowedchars += self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
                     else:
-                        print('bug : cant terminate 4', info)
-                        raise ValueError
+                        allowedchars += self.voc.dot_number + self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
 
-                # Case space left is 2 -------------
-                elif space_left == 2 :
-
-                    if can_be_terminated == 1:
-                        if vec_number == 0: #must add a vector
-                            allowedchars = self.voc.arity0_vec
-                        elif vec_number==1:
-                            allowedchars = self.voc.terminalsymbol
-                            allowedchars += self.voc.arity0symbols
-                        else:
-                            print('must not happen 5', info)
-                            raise ValueError
-
-                    elif can_be_terminated == 2: #operator required
-                        if vec_number == 0:
-                            print('must not happen 6', info)
-                            raise ValueError
-
-                        elif vec_number == 1:
-                            if stack[-2:] == [0,1]:
-                                allowedchars = self.voc.multnumber
-                            elif stack[-2:] == [1, 0]:
-                                allowedchars = self.voc.multnumber + self.voc.divnumber
-                            else:
-                                print('bug fixing 7', info)
-                                raise ValueError
-
-                        elif vec_number == 2: #op required and decrease vec number, thus:
-                            allowedchars = self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
-
-                        else:
-                            print('bug fixing 8', info)
-                            raise ValueError
-
-                    elif can_be_terminated == 3: #two operators required
-                        if vec_number == 0:
-                            print('must not happen 9', info)
-                            raise ValueError
-                        elif vec_number == 1:
-                            if stack[-3:] == [0,0,1]:
-                                allowedchars = self.voc.multnumber
-                            elif stack == [0,1,0]:
-                                allowedchars = self.voc.multnumber + self.voc.divnumber
-                            elif stack == [1,0,0]:
-                                allowedchars = self.voc.arity2novec
-                            else:
-                                print('bugfixing10', info)
-                                raise ValueError
-                        elif vec_number == 2: #2 op required and minus one vector:
-                            if stack[-3:] == [0,1,1]:
-                                allowedchars = self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
-                            elif stack == [1,0,1]:
-                                allowedchars = self.voc.multnumber
-                            elif stack == [1,1,0]:
-                                allowedchars = self.voc.multnumber + self.voc.divnumber
-                            else:
-                                print('bugfixing11', info)
-                                raise ValueError
-
-                        elif vec_number == 3: # case stack 1 1 1
-                            allowedchars = self.voc.dot_number + self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
-                        else:
-                            print('bugfixing11', info)
-                            raise ValueError
-
-                # General case-------------
-                elif space_left >= 3:
-                    t = can_be_terminated - 1  # this equals to the number of operators required
-                    nu = vec_number - 1  # number of extra vectors : if >=1 : must reduce the number of vectors
-                    p = space_left
-                    allowedchars = []
-                    if nu == 0 and t == 0:
-                        allowedchars = self.voc.terminalsymbol
-
-                    if p < t:
-                        print('impossible to terminate must not happen 12', info)
-                        raise ValueError
+            elif p == t+1:
+                # cant add a scalar, but functions,and norm
+                if stack[-1] == 0 and functions_allowed:
+                    allowedchars += self.voc.arity1_novec
+                elif stack[-1] == 1 and nu >=1 and functions_allowed:
+                    allowedchars += self.voc.norm_number
 
-                    elif p == t: # t operators required in t space left : only operators allowed here
-                        if nu == -1:
-                            print('impossible to terminate with a vec expression  13: shd never happen', info)
-                            raise ValueError
-                        elif nu >= 0:
-                            lasts = stack[-2:]
-                            if lasts == [0,0]:
-                                allowedchars += self.voc.arity2novec
-                            elif lasts == [0,1]:
-                                allowedchars += self.voc.multnumber
-                            elif lasts == [1, 0]:
-                                allowedchars += self.voc.multnumber + self.voc.divnumber
-                            elif lasts == [1,1] and nu <=1:
-                                allowedchars += self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
-                            else:
-                                allowedchars += self.voc.dot_number + self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
-
-                    elif p == t+1:
-                        # cant add a scalar, but functions,and norm
-                        if stack[-1] == 0 and self.getnumberoffunctions() < config.MAX_DEPTH:
-                            allowedchars += self.voc.arity1_novec
-                        elif stack[-1] == 1 and nu >=1 and self.getnumberoffunctions() < config.MAX_DEPTH:
-                            allowedchars += self.voc.norm_number
-
-                        lasts = stack[-2:]
-                        if lasts == [0, 0]:
-                            allowedchars += self.voc.arity2novec
-                        if lasts == [0, 1]:
-                            allowedchars += self.voc.multnumber
-                        if lasts == [1, 0]:
-                            allowedchars += self.voc.multnumber + self.voc.divnumber
-                        if lasts == [1, 1]:
-                            allowedchars += self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
-                        if lasts == [1,1] and nu >=2 and self.getnumberoffunctions() < config.MAX_DEPTH:
-                            allowedchars+= self.voc.dot_number
-
-                    else :
-                        if nu==-1:
-                            allowedchars  += self.voc.arity0_vec
-                        elif nu >= 0:
-                            allowedchars += self.voc.arity0symbols
-                            if stack[-1] == 0 and self.getnumberoffunctions() < config.MAX_DEPTH:
-                                allowedchars+= self.voc.arity1_novec
-                            if stack[-1] == 1 and nu>=1 and self.getnumberoffunctions() < config.MAX_DEPTH:
-                                allowedchars += self.voc.norm_number
-                            if stack[-1] == 1 and nu == 1 and self.getnumberoffunctions() < config.MAX_DEPTH and p-(t+1) >=3:
-                                allowedchars += self.voc.norm_number
-
-                            lasts = stack[-2:]
-                            if lasts == [0, 0]:
-                                allowedchars += self.voc.arity2novec
-                            if lasts == [0, 1]:
-                                allowedchars += self.voc.multnumber
-                            if lasts == [1, 0]:
-                                allowedchars += self.voc.multnumber + self.voc.divnumber
-                            if lasts == [1,1]:
-                                allowedchars += self.voc.dot_number + self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
-
-                    # option that counter the tendency to create too long expresions : enforce terminal state now and then:
-                    if True:
-                        if nu==0 and t==0:
-                            if random.random() < config.force_terminal:
-                                allowedchars = self.voc.terminalsymbol
-                            else:
-                                pass
+                lasts = stack[-2:]
+                if lasts == [0, 0]:
+                    allowedchars += self.voc.arity2novec
+                if lasts == [0, 1]:
+                    allowedchars += self.voc.multnumber
+                if lasts == [1, 0]:
+                    allowedchars += self.voc.multnumber + self.voc.divnumber
+                if lasts == [1, 1]:
+                    allowedchars += self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
+                if lasts == [1,1] and nu >=2 and functions_allowed:
+                    allowedchars+= self.voc.dot_number
+
+            else :
+                if nu==-1:
+                    allowedchars  += self.voc.arity0_vec
+                elif nu >= 0:
+                    allowedchars += self.voc.arity0symbols
+                    if stack[-1] == 0 and functions_allowed:
+                        allowedchars+= self.voc.arity1_novec
+                    if stack[-1] == 1 and nu>=1 and functions_allowed:
+                        allowedchars += self.voc.norm_number
+                    if stack[-1] == 1 and nu == 1 and functions_allowed and p-(t+1) >=3:
+                        allowedchars += self.voc.norm_number
+
+                    lasts = stack[-2:]
+                    if lasts == [0, 0]:
+                        allowedchars += self.voc.arity2novec
+                    if lasts == [0, 1]:
+                        allowedchars += self.voc.multnumber
+                    if lasts == [1, 0]:
+                        allowedchars += self.voc.multnumber + self.voc.divnumber
+                    if lasts == [1,1]:
+                        allowedchars += self.voc.dot_number + self.voc.plusnumber + self.voc.minusnumber + self.voc.wedge_number
 
-        return allowedchars
+            # the option that counter the tendency to create too long expresions (see allowedmoves_vectorial)
+            can_force_terminal = nu == 0 and t == 0
+
+        return tuple(allowedchars), can_force_terminal
 
     # ---------------------------------------------------------------------------- #
     def allowedmoves_novectors(self):
         # determines which character can be added to the rpn in scalar only mode, quite similar though simpler
+        # (and also kept in the table of the voc, see scalar_moves)
+        return self.table_moves()[0]
 
-        current_state_size = len(self.state.reversepolish)
-        space_left = self.maxL - current_state_size
+    # ---------------------------------------------------------------------------- #
+    def scalar_moves(self, space_left, scalarcount, last_is_number, numbers_allowed, functions_allowed):
+        # the allowed moves of allowedmoves_novectors
+        # check if we must terminate
+        if space_left == 1:
+            if scalarcount == 1 : #expression is a scalar -> ok, terminate
+                allowedchars = self.voc.terminalsymbol
+
+            else: # scalarcount cant be greater than 2 at that point thanks to the code afterwards:
+
+                # take care of power specifics (option)
+                if config.only_scalar_in_power:
+                    if last_is_number:
+                        allowedchars = self.voc.arity2symbols
+                    else:
+                        allowedchars = self.voc.arity2symbols_no_power
 
-        #init : we go upward so we must start with a scalar
-        if current_state_size == 0:
-            allowedchars = self.voc.arity0symbols
+                else:
+                    allowedchars = self.voc.arity2symbols
 
+        # case space left >=2
         else:
-            #check if already terminated
-            if self.state.reversepolish[-1] in self.voc.terminalsymbol or space_left == 0:
-                allowedchars = []
-
-            else:
-                scalarcount = self.scalar_counter()
-                current_A_number =  sum([1 for x in self.state.reversepolish if x in self.voc.pure_numbers])
+            if scalarcount == 1:
+                allowedchars = self.voc.terminalsymbol
 
-                # check if we must terminate
-                if space_left == 1:
-                    if scalarcount == 1 : #expression is a scalar -> ok, terminate
-                        allowedchars = self.voc.terminalsymbol
+                if space_left >= scalarcount + 1:
+                    if numbers_allowed:
+                        allowedchars += self.voc.arity0symbols
+                    else:
+                        allowedchars += self.voc.arity0symbols_var_and_tar
 
-                    else: # scalarcount cant be greater than 2 at that point thanks to the code afterwards:
+                if space_left >= scalarcount:
+                    if functions_allowed :
+                        allowedchars += self.voc.arity1symbols
 
-                        # take care of power specifics (option)
-                        if config.only_scalar_in_power:
-                            if self.state.reversepolish[-1] in self.voc.pure_numbers:
-                                allowedchars = self.voc.arity2symbols
-                            else:
-                                allowedchars = self.voc.arity2symbols_no_power
 
-                        else:
-                            allowedchars = self.voc.arity2symbols
+            if scalarcount >= 2:
+                #take care of power specifics
+                if config.only_scalar_in_power :
+                    if last_is_number:
+                        allowedchars = self.voc.arity2symbols
+                    else:
+                        allowedchars = self.voc.arity2symbols_no_power
 
-                # case space left >=2
                 else:
-                    if scalarcount == 1:
-                        allowedchars = self.voc.terminalsymbol
-
-                        if space_left >= scalarcount + 1:
-                            if current_A_number < config.max_A_number:
-                                allowedchars += self.voc.arity0symbols
-                            else:
-                                allowedchars += self.voc.arity0symbols_var_and_tar
-
-                        if space_left >= scalarcount:
-                            if self.getnumberoffunctions() < config.MAX_DEPTH :
-                                allowedchars += self.voc.arity1symbols
-
-
-                    if scalarcount >= 2:
-                        #take care of power specifics
-                        if config.only_scalar_in_power :
-                            if self.state.reversepolish[-1] in self.voc.pure_numbers:
-                                allowedchars = self.voc.arity2symbols
-                            else:
-                                allowedchars = self.voc.arity2symbols_no_power
-
-                        else:
-                            allowedchars = self.voc.arity2symbols
-
-                        if space_left >= scalarcount+1:
-                            if current_A_number < config.max_A_number:
-                                allowedchars += self.voc.arity0symbols
-                            else:
-                                allowedchars += self.voc.arity0symbols_var_and_tar
-
-                        if space_left >= scalarcount:
-                            # also avoid stuff like exp(exp(exp(exp(sin(x))))
-                            if self.getnumberoffunctions() < config.MAX_DEPTH :
-                                allowedchars += self.voc.arity1symbols
+                    allowedchars = self.voc.arity2symbols
 
-        return allowedchars
+                if space_left >= scalarcount+1:
+                    if numbers_allowed:
+                        allowedchars += self.voc.arity0symbols
+                    else:
+                        allowedchars += self.voc.arity0symbols_var_and_tar
+
+                if space_left >= scalarcount:
+                    # also avoid stuff like exp(exp(exp(exp(sin(x))))
+                    if functions_allowed :
+                        allowedchars += self.voc.arity1symbols
+
+        return tuple(allowedchars)
 
     # ---------------------------------------------------------------------------- #
     def getnumberoffunctions(self, state = None):
-        # returns the number of *nested* functions
-        # use the same stack as everywhere else but only keep in the stack the number of nested functions encountered so far
-        stack = []
+        # returns the number of *nested* functions (on top of the stack : see State.grammar)
         if state is None:
             state = self.state
-        for number in state.reversepolish:
-            if number in self.voc.arity0symbols or number in self.voc.true_zero_number or number in self.voc.neutral_element:
-                stack += [0]
-
-            elif number in self.voc.arity1symbols:
-                if len(stack) == 1:
-                    stack = [stack[0] +1]
-                else:
-                    stack = stack[0:-1] + [stack[-1] + 1]
-
-            elif number in self.voc.arity2symbols:
-                stack = stack[0:-2] + [max(stack[-1], stack[-2])]
-
-        if len(stack)>0:
-            return stack[-1]
+        depths = state.grammar[3]
+        if depths is not None:
+            return depths[0]
         else:
             return 0
     #---------------------------------------------------------------------- #
     def nextstate(self, nextchar):
         ''' Given a next char, produce nextstate WITHOUT ACTUALLY UPDATING THE STATE (it is a virtual move)'''
-        nextstate = copy.deepcopy(self.state.reversepolish)
-        nextstate.append(nextchar)
-        return State(self.voc, nextstate, self.calculus_mode)
+        return self.state.extended(nextchar)
 
     # ---------------------------------------------------------------------------- #
     def takestep(self, nextchar):
@@ -460,12 +360,12 @@ class Game:
     # ---------------------------------------------------------------------------- #
     def isterminal(self):
         if self.calculus_mode == 'scalar':
-            if self.allowedmoves_novectors() == []:
+            if len(self.allowedmoves_novectors()) == 0:
                 return 1
             else:
                 return 0
         if self.calculus_mode == 'vectorial':
-            if self.allowedmoves_vectorial() == []:
+            if len(self.allowedmoves_vectorial()) == 0:
                 return 1
             else:
                 return 0
@@ -491,11 +391,12 @@ class Game:
                 stack_of_nodes += [ast.onebottomnode]
 
             else:
-                if number in self.voc.arity0symbols or number in self.voc.true_zero_number or number in self.voc.neutral_element:
+                arity = self.voc.token_arity[number]
+                if arity == 0:
                     newnode = Node(number, 0, None, None ,count)
                     stack_of_nodes += [newnode]
 
-                elif number in self.voc.arity1symbols:
+                elif arity == 1:
                     lastnode = stack_of_nodes[-1]
                     newnode = Node(number, 1, [lastnode], None ,count)
                     lastnode.parent = newnode
@@ -504,7 +405,7 @@ class Game:
                     if len(stack_of_nodes) >= 2:
                         stack_of_nodes = stack_of_nodes[:-1] + [newnode]
 
-                elif number in self.voc.arity2symbols:
+                elif arity == 2:
                     newnode = Node(number, 2, [stack_of_nodes[-2], stack_of_nodes[-1]], None, count)
                     stack_of_nodes[-2].parent = newnode
                     stack_of_nodes[-1].parent = newnode
@@ -519,25 +420,27 @@ class Game:
     def get_features(self):
         # returns the numbers used to populate the Quality-Diversity Grid
 
-        if self.state.reversepolish[-1] in self.voc.terminalsymbol:
-            L = len(self.state.reversepolish) - 1
+        if self.voc.token_kind[self.state.last] == 'halt':
+            L = self.state.length - 1
         else:
-            L = len(self.state.reversepolish)
+            L = self.state.length
 
         function_number = 0
         mytargetnumber = 0
         firstder_number = 0
         depth = self.getnumberoffunctions()
         varnumber = 0
+        token_kind = self.voc.token_kind
         if self.calculus_mode == 'scalar':
-            for char in self.state.reversepolish:
-                if char in self.voc.arity1symbols:
+            for char in self.state.tokens:
+                kind = token_kind[char]
+                if kind == 'function':
                     function_number += 1
-                elif char in self.voc.targetfunction_number:
+                elif kind == 'target':
                     mytargetnumber += 1
-                elif char in self.voc.first_der_number:
+                elif kind == 'derivative':
                     firstder_number += 1
-                elif char in self.voc.var_numbers:
+                elif kind == 'variable':
                     varnumber += 1
             return L, function_number, mytargetnumber, firstder_number, depth, varnumber
 
@@ -545,20 +448,21 @@ class Game:
             dotnumber = 0
             normnumber = 0
             crossnumber =0
-            for char in self.state.reversepolish:
-                if char in self.voc.arity1_novec:
+            for char in self.state.tokens:
+                kind = token_kind[char]
+                if kind == 'function':
                     function_number += 1
-                elif char in self.voc.targetfunction_number:
+                elif kind == 'target':
                     mytargetnumber += 1
-                elif char in self.voc.first_der_number:
+                elif kind == 'derivative':
                     firstder_number += 1
-                elif char in self.voc.wedge_number:
+                elif kind == 'wedge':
                     crossnumber += 1
-                elif char in self.voc.norm_number:
+                elif kind == 'norm':
                     normnumber += 1
-                elif char in self.voc.dot_number:
+                elif kind == 'dot':
                     dotnumber += 1
-                elif char in self.voc.var_numbers:
+                elif kind == 'variable':
                     varnumber += 1
             return L, function_number, mytargetnumber, firstder_number, depth, varnumber, dotnumber, normnumber, crossnumber
 
@@ -588,6 +492,255 @@ def randomeqs(voc):
     else:
         return game
 
+# ---------------------------------------------------------------------------- #
+# create n random eqs at once, drawn as randomeqs does
+
+def random_rpn_matrix(voc, n):
+    ''' returns the tokens of n random equations, one row per equation padded with zeros, and their lengths.
+    All the equations grow together, one token per step : their grammar is kept in arrays (as in State.grammar_step),
+    and the equations with the same allowed moves (the same key of the move table, see Game.allowedmoves_vectorial
+    and Game.allowedmoves_novectors) get their next tokens in one draw '''
+    maxL = voc.maximal_size
+    vectorial = voc.calculus_mode == 'vectorial'
+    game = Game(voc)
+    arity = np.array([-1 if a is None else a for a in voc.token_arity])
+    kind = np.array([str(k) for k in voc.token_kind])
+    vector = np.array(voc.token_vector)
+    scalars = np.array(voc.token_scalars)
+    halt = voc.terminalsymbol[0]
+
+    tokens = np.zeros((n, maxL), dtype=np.int16)
+    lengths = np.zeros(n, dtype=int)
+    # grammar : number of operands, of vectors, of free scalars ; stacks of the types and the depths of the operands
+    count = np.zeros(n, dtype=int)
+    vec_number = np.zeros(n, dtype=int)
+    a_number = np.zeros(n, dtype=int)
+    types = np.zeros((n, maxL + 1), dtype=int)
+    depths = np.zeros((n, maxL + 1), dtype=int)
+    active = np.ones(n, dtype=bool)
+
+    for step in range(maxL):
+        rows = np.flatnonzero(active)
+        if rows.size == 0:
+            break
+
+        # ------- draw the next tokens
+        if step == 0:
+            chars = np.asarray(voc.arity0symbols)[np.random.randint(len(voc.arity0symbols), size=rows.size)]
+        else:
+            space_left = maxL - step
+            c = count[rows]
+            functions_allowed = np.where(c > 0, depths[rows, np.maximum(c - 1, 0)], 0) < config.MAX_DEPTH
+            if vectorial:
+                # the last three types (-1 : none), and -2 first if there are more (see Game.from_rpn_to_critical_info)
+                lasts = [np.where(c >= j, types[rows, np.maximum(c - j, 0)], -1) for j in [3, 2, 1]]
+                columns = [c, vec_number[rows], np.where(c >= 4, -2, -1)] + lasts + [functions_allowed]
+            else:
+                columns = [c, kind[tokens[rows, step - 1]] == 'number', a_number[rows] < config.max_A_number, functions_allowed]
+            keys, inverse = np.unique(np.stack(columns, axis=1).astype(int), axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+
+            chars = np.zeros(rows.size, dtype=int)
+            for g, key in enumerate(keys):
+                members = np.flatnonzero(inverse == g)
+                if vectorial:
+                    stack = tuple(None if t == -2 else int(t) for t in key[2:6] if t != -1)
+                    key = ('vectorial', space_left, int(key[0]), int(key[1]), stack, bool(key[6]))
+                    if key not in voc.move_table:
+                        voc.move_table[key] = game.vectorial_moves(*key[1:])
+                    allowedchars, can_force_terminal = voc.move_table[key]
+                else:
+                    key = ('scalar', space_left, int(key[0]), bool(key[1]), bool(key[2]), bool(key[3]))
+                    if key not in voc.move_table:
+                        voc.move_table[key] = game.scalar_moves(*key[1:])
+                    allowedchars, can_force_terminal = voc.move_table[key], False
+
+                if len(allowedchars) == 0:  # terminal (chars left to zero)
+                    continue
+                drawn = np.asarray(allowedchars)[np.random.randint(len(allowedchars), size=members.size)]
+                if can_force_terminal:
+                    drawn[np.random.random(members.size) < config.force_terminal] = halt
+                chars[members] = drawn
+
+            active[rows[chars == 0]] = False
+            rows, chars = rows[chars != 0], chars[chars != 0]
+
+        tokens[rows, step] = chars
+        lengths[rows] += 1
+
+        # ------- update the grammar
+        a_number[rows] += scalars[chars]
+        arities = arity[chars]
+
+        new = rows[arities == 0]
+        added = vector[chars[arities == 0]]
+        types[new, count[new]] = added
+        depths[new, count[new]] = 0
+        count[new] += 1
+        vec_number[new] += added
+
+        functions = rows[arities == 1]
+        depths[functions, count[functions] - 1] += 1
+        norms = rows[(arities == 1) & (kind[chars] == 'norm')]
+        types[norms, count[norms] - 1] = 0
+        vec_number[norms] -= 1
+
+        binary = arities == 2
+        operators = rows[binary]
+        operator_kind = kind[chars[binary]]
+        left, right = count[operators] - 2, count[operators] - 1
+        depths[operators, left] = np.maximum(depths[operators, left], depths[operators, right])
+        left_type, right_type = types[operators, left], types[operators, right]
+        added = np.select([operator_kind == 'mult', operator_kind == 'power', operator_kind == 'wedge', operator_kind == 'dot'],
+                          [left_type | right_type, 0, 1, 0], left_type)
+        vec_number[operators] -= np.select([(operator_kind == 'plus') | (operator_kind == 'minus'), operator_kind == 'wedge',
+                                            operator_kind == 'dot'], [left_type & right_type, 1, 2], 0)
+        types[operators, left] = added
+        count[operators] -= 1
+
+        active[rows[kind[chars] == 'halt']] = False
+
+    return tokens, lengths
+
+def randomstates(voc, n):
+    # n random states at once (see random_rpn_matrix)
+    tokens, lengths = random_rpn_matrix(voc, n)
+    states = []
+    for row, length in zip(tokens, lengths):
+        state = State(voc, row[:length].tolist(), voc.calculus_mode)
+        if config.use_simplif:
+            state = simplif_eq(voc, state, voc.calculus_mode)
+        states.append(state)
+    return states
+
+# ---------------------------------------------------------------------------- #
+# random eqs drawn uniformly among all the equations of a given size. In scalar mode, the equations the game allows are
+# exactly the trees of the voc with at most config.MAX_DEPTH nested functions, a free scalar as exponent
+# (config.only_scalar_in_power), and at most voc.maximal_size tokens (without a function at the top at that size : the
+# halt is forced). The size is the number of tokens, the halt not included.
+# Subtrees are counted once by size and class (type, depth, and whether it is a single free scalar), with the ways
+# to build them : voc.completion_table[(size, class)] = (number of subtrees, their last token and operands, cumulated numbers)
+# In vectorial mode the trees also have operands of the right types and a vector at the top, but the game further limits
+# the norm, dot and cross products by the vectors left on the stack when they are read : the trees it does not allow
+# are drawn again (see uniform_randomstate)
+
+def subtree_counts(voc):
+    table = voc.completion_table
+    if len(table) > 0:
+        return table
+    if voc.calculus_mode == 'scalar' and voc.maximal_size > config.max_A_number:
+        print('uniform random eqs : the number of free scalars must not be limited by config.max_A_number')
+        raise ValueError
+
+    classes = [(t, d, n) for t in [0, 1] for d in range(config.MAX_DEPTH + 1) for n in [0, 1]]
+    for size in range(1, voc.maximal_size + 1):
+        ways = {cls: [0, [], []] for cls in classes}
+
+        def add(cls, production, number):
+            if number > 0:
+                ways[cls][0] += number
+                ways[cls][1].append(production)
+                ways[cls][2].append(ways[cls][0])
+
+        if size == 1:
+            for char in voc.arity0symbols:
+                add((voc.token_vector[char], 0, int(voc.token_kind[char] == 'number')), (char,), 1)
+
+        for char in voc.arity1symbols:
+            if size == voc.maximal_size:
+                break
+            for (t, d, n) in classes:
+                if t in unary_types[voc.token_kind[char]] and d < config.MAX_DEPTH:
+                    operand = (size - 1, (t, d, n))
+                    add((unary_types[voc.token_kind[char]][t], d + 1, 0), (char, operand), subtree_count(voc, *operand))
+
+        for char in voc.arity2symbols:
+            kind = voc.token_kind[char]
+            only_numbers = voc.calculus_mode == 'scalar' and kind == 'power' and config.only_scalar_in_power
+            for k in range(1, size - 1):
+                for left in classes:
+                    for right in classes:
+                        if (left[0], right[0]) in binary_types[kind] and (right[2] == 1 or not only_numbers):
+                            number = subtree_count(voc, k, left) * subtree_count(voc, size - 1 - k, right)
+                            add((binary_types[kind][(left[0], right[0])], max(left[1], right[1]), 0),
+                                (char, (k, left), (size - 1 - k, right)), number)
+
+        for cls in classes:
+            table[(size, cls)] = tuple(ways[cls])
+    return table
+
+def subtree_count(voc, size, cls):
+    if size < 1:
+        return 0
+    return voc.completion_table[(size, cls)][0]
+
+def equation_classes(voc, size):
+    # the classes of the whole equation, with their number of equations
+    table = subtree_counts(voc)
+    top_type = 1 if voc.calculus_mode == 'vectorial' else 0
+    return [(cls, table[(size, cls)][0]) for (s, cls) in table if s == size and cls[0] == top_type]
+
+def equation_sizes(voc):
+    # the sizes an equation can have, with their number of equations
+    sizes = {}
+    for size in range(1, voc.maximal_size + 1):
+        number = sum(n for cls, n in equation_classes(voc, size))
+        if number > 0:
+            sizes.update({size: number})
+    return sizes
+
+def random_subtree(voc, size, cls):
+    total, productions, cumulated = voc.completion_table[(size, cls)]
+    production = productions[bisect.bisect_right(cumulated, random.randrange(total))]
+    rpn = []
+    for operand in production[1:]:
+        rpn += random_subtree(voc, *operand)
+    return rpn + [production[0]]
+
+def allowed_by_game(voc, rpn):
+    game = Game(voc)
+    for char in rpn:
+        if char not in game.table_moves()[0]:
+            return False
+        game.takestep(char)
+    return len(game.table_moves()[0]) == 0
+
+def uniform_randomstate(voc, size, max_tries = 1000):
+    # one equation of this size, all of them with the same probability (None if none was found in vectorial mode)
+    classes = equation_classes(voc, size)
+    total = sum(n for cls, n in classes)
+    if total == 0:
+        print('no equation of size', size)
+        raise ValueError
+
+    for _ in range(max_tries):
+        draw = random.randrange(total)
+        for cls, n in classes:
+            if draw < n:
+                break
+            draw -= n
+        rpn = random_subtree(voc, size, cls)
+        if size < voc.maximal_size:
+            rpn += [voc.terminalsymbol[0]]
+        if voc.calculus_mode == 'scalar' or allowed_by_game(voc, rpn):
+            return State(voc, rpn, voc.calculus_mode)
+    return None
+
+def uniform_randomstates(voc, n):
+    # n random states, their sizes drawn uniformly among the possible ones (see uniform_randomstate)
+    sizes = list(equation_sizes(voc))
+    states = []
+    while len(states) < n and len(sizes) > 0:
+        size = random.choice(sizes)
+        state = uniform_randomstate(voc, size)
+        if state is None:
+            sizes.remove(size)
+            continue
+        if config.use_simplif:
+            state = simplif_eq(voc, state, voc.calculus_mode)
+        states.append(state)
+    return states
+
 # ---------------------------------------------------------
 def simplif_eq(voc, state, calculus_mode):
     count = 0
@@ -624,10 +777,20 @@ def complete_eq_with_random(voc, state, calculus_mode):
         return game.state
 
 # -------------------------------------------------------------------------- #
-def game_evaluate(rpn, formulas, voc, train_targets, diffmode, u, look_for):
+# key under which the fit of an equation is remembered (memo of run_one_target, fitness store) : the rpn with the operands
+# of + and * (whole chains of them, flattened) and of the dot product in a fixed order, so that A x0 + and x0 A +, or
+# (a*b)*c and a*(c*b), share it (see SubtreeStore.key)
+def state_key(state):
+    nodes = state.nodes
+    if len(nodes) != 1:
+        return str(state.reversepolish)
+    return state.voc.subtrees.key(nodes[0])
+
+# -------------------------------------------------------------------------- #
+def game_evaluate(rpn, formulas, voc, train_targets, diffmode, u, look_for, initial_A = None):
     # infinite symbol only comes from simplification if used
         if voc.infinite_number[0] in rpn:
             return 0, [], 100000000
         else:
-            myfit = Evaluatefit(formulas, voc, train_targets, diffmode, u, look_for)
+            myfit = Evaluatefit(formulas, voc, train_targets, diffmode, u, look_for, rpn, initial_A)
         return myfit.evaluate()
\ No newline at end of file
@@ -9,7 +9,7 @@
 # ================================= PREAMBLE ================================= #
 # Packages
 from game_env import Game
-from State import State
+from State import State, empty_grammar, grammar_step, last_types
 import numpy as np
 import random
 import config
@@ -32,6 +32,55 @@ class generate_offsprings():
         self.voc = voc
         self.calculus_mode = calculus_mode
 
+    # ---------------------------------------------------------------------------- #
+    # warm start : the constants fitted for a parent follow its free scalars into the offspring, so that the fit of
+    # the offspring can start from there (see Evaluatefit)
+
+    def constant_width(self, char):
+        # how many fitted constants a symbol carries : one for a free scalar A, three for a free vector B
+        symbol = self.voc.token_formula[char]
+        if symbol == 'A':
+            return 1
+        elif symbol == 'B':
+            return 3
+        return 0
+
+    def constants_by_position(self, state):
+        # for each symbol of the rpn, its fitted constants or None
+        values = [None]*len(state.reversepolish)
+        fitted = getattr(state, 'fitted_A', None)
+        if fitted is None:
+            return values
+
+        c = 0
+        for i, char in enumerate(state.reversepolish):
+            width = self.constant_width(char)
+            if width > 0:
+                if c + width > len(fitted):
+                    break
+                values[i] = list(fitted[c:c + width])
+                c += width
+        return values
+
+    def carry_constants(self, state, rpn, values):
+        # values are given for rpn : lost if the simplification rewrote the state. Unknown constants are nan
+        state.initial_A = None
+        if state.reversepolish != rpn:
+            return state
+
+        initial = []
+        for char, value in zip(rpn, values):
+            width = self.constant_width(char)
+            if width > 0:
+                if value is not None and len(value) == width:
+                    initial += value
+                else:
+                    initial += [np.nan]*width
+
+        if not np.all(np.isnan(initial)):
+            state.initial_A = initial
+        return state
+
     # ---------------------------------------------------------------------------- #
     # mutation, returns succes or not, and the new state
     # mutaion can fail if simplification is allowed and the new state is infinity
@@ -51,16 +100,18 @@ class generate_offsprings():
 
         char = prev_rpn[char_to_mutate]
 
+        arity = self.voc.token_arity[char]
+
         # ------ arity 0 -------
-        if char in self.voc.arity0symbols or char in self.voc.neutral_element or char in self.voc.true_zero_number:
+        if arity == 0:
             newchar = random.choice(tuple(x for x in self.voc.arity0symbols if x != char))
 
         # ------ arity 1 -------
-        elif char in self.voc.arity1symbols:
+        elif arity == 1:
             newchar = random.choice(tuple(x for x in self.voc.arity1symbols if x != char))
 
         # ------ arity 2 -------
-        elif char in self.voc.arity2symbols:
+        elif arity == 2:
             newchar = random.choice(tuple(x for x in self.voc.arity2symbols if x != char))
 
         else:
@@ -69,18 +120,23 @@ class generate_offsprings():
 
 
         # --------  option to avoid too many arity 1
-        if random.random() < self.delete_ar1_ratio and char in self.voc.arity1symbols:
+        values = self.constants_by_position(state)
+        if random.random() < self.delete_ar1_ratio and arity == 1:
             # delete arity one
             newrpn = prev_rpn[:char_to_mutate] + prev_rpn[char_to_mutate + 1:]
+            values = values[:char_to_mutate] + values[char_to_mutate + 1:]
             newstate = State(self.voc, newrpn, self.calculus_mode)
         else:
             # or mutate
             prev_rpn[char_to_mutate] = newchar
+            values[char_to_mutate] = None
             newstate = State(self.voc, prev_rpn, self.calculus_mode)
+        newrpn = newstate.reversepolish
 
         # -------- return the new state:
         if self.usesimplif:
             newstate = game_env.simplif_eq(self.voc, newstate)
+        self.carry_constants(newstate, newrpn, values)
         # mutation can lead to true zero division (after simplif) thus :
         if self.voc.infinite_number[0] not in newstate.reversepolish :
             return True, newstate
@@ -89,86 +145,11 @@ class generate_offsprings():
 
     # -----------------------------
     def get_current_stack(self, cut_state):
-        stack = [] #see game_env : similar
-
+        # the types of the operands (0 scalar, 1 vector) once cut_state is read : see State.grammar_step
+        grammar = empty_grammar
         for char in cut_state:
-            # arity 0
-            if char in self.voc.terminalsymbol:
-                pass
-            elif char in self.voc.arity0symbols:
-                if char in self.voc.arity0_vec:
-                    stack.append(1)
-                else:
-                    stack.append(0)
-
-            # arity 1
-            elif char in self.voc.arity1symbols:
-                if char in self.voc.norm_number:
-                    if stack[-1] == 1:
-                        stack = stack[:-1] + [0]
-                    else:
-                        print('ofixbug: cant take the norm of a scalar')
-                        raise ValueError
-                # if function like cos : stack doesnt change but for debug:
-                else:
-                    if stack[-1] != 0:
-                        print('ocant take cosine of a vector (no pointwise operations allowed by choice)')
-                        raise ValueError
-
-            else:  # arity 2
-                lasts = stack[-2:]
-
-                if char in self.voc.divnumber:  # can only be [1, 0] : vector divided by scalar gives a vector:
-                    if lasts == [1, 0]:
-                        toadd = [1]
-                    elif lasts == [0, 0]:
-                        toadd = [0]
-                    else:
-                        print('ofixbug: scalar cant be divided by vector; or vector by vector')
-                        raise ValueError
-
-                elif char in self.voc.multnumber:
-                    if lasts == [0, 0]:
-                        toadd = [0]
-                    elif lasts == [0, 1] or lasts == [1, 0]:
-                        toadd = [1]
-                    else:
-                        print('ofixbug: vectors cant be multiplied', cut_state)
-                        raise ValueError
-
-                elif char in self.voc.plusnumber or char in self.voc.minusnumber:
-                    if lasts == [0, 0]:
-                        toadd = [0]
-                    elif lasts == [0, 1] or lasts == [1, 0]:
-                        print('ofixbug: scalars cant be added to a vector')
-                        raise ValueError
-                    else:  # add two vectors : reduce n_vec one unit
-                        toadd = [1]
-                elif char in self.voc.power_number:
-                    if lasts == [0, 0]:
-                        toadd = [0]
-                    else:
-                        print('obugfixing : power not authorized here')
-                        raise ValueError
-
-                elif char in self.voc.wedge_number:
-                    if lasts == [1, 1]:
-                        toadd = [1]
-                    else:
-                        print('obug : wedge not allowed')
-                        raise ValueError
-
-                elif char in self.voc.dot_number:
-                    if lasts == [1, 1]:
-                        toadd = [0]
-                    else:
-                        print('obug : dot product not allowed')
-                        raise ValueError
-
-                # update stack for case arity 2
-                stack = stack[:-2] + toadd
-
-        return stack
+            grammar = grammar_step(self.voc, self.calculus_mode, grammar, char)
+        return last_types(grammar[2], len(cut_state))
     # -------------------------------
     def vectorial_mutation(self, state):
 
@@ -185,29 +166,32 @@ class generate_offsprings():
 
         char = prev_rpn[char_to_mutate]
 
+        arity = self.voc.token_arity[char]
+        kind = self.voc.token_kind[char]
+
         # ------ arity 0 -------
 
-        if char in self.voc.arity0_vec:
+        if arity == 0 and self.voc.token_vector[char]:
             if len(self.voc.arity0_vec) >1:
                newchar = random.choice(tuple(x for x in self.voc.arity0_vec if x != char))
             else:
                 newchar = char
 
-        elif char in self.voc.arity0_novec:
+        elif arity == 0:
             if len(self.voc.arity0_novec) >1:
                 newchar = random.choice(tuple(x for x in self.voc.arity0_novec if x != char))
             else:
                 newchar = char
 
         # ------ arity 1 -------
-        elif char in self.voc.arity1_novec:
+        elif kind == 'function':
             newchar = random.choice(tuple(x for x in self.voc.arity1_novec if x != char))
 
-        elif char in self.voc.arity1_vec:
+        elif kind == 'norm':
             newchar = char
 
         # ------ arity 2 -------
-        elif char in self.voc.arity2symbols:
+        elif arity == 2:
             cut_state = prev_rpn[:char_to_mutate]
             stack = self.get_current_stack(cut_state)
             # mutation depends on the stack
@@ -218,7 +202,7 @@ class generate_offsprings():
             elif stack[-2:] == [1,0]: # was * or /
                 newchar = random.choice(tuple(x for x in [self.voc.multnumber[0], self.voc.divnumber[0]] if x != char))
             elif stack[-2:] == [1, 1]:  # was +, -, wedge, or dot.
-                if char in self.voc.dot_number: #cant mutate
+                if kind == 'dot': #cant mutate
                     newchar = char
                 else:
                     # by running too many cross happen : we cut this off with the following :
@@ -228,335 +212,179 @@ class generate_offsprings():
             raise ValueError
 
         # --------  finally : I mutate or simply delete the char if -------
-        if random.random() < self.delete_ar1_ratio and char in self.voc.arity1_novec:
+        values = self.constants_by_position(state)
+        if random.random() < self.delete_ar1_ratio and kind == 'function':
             newrpn = prev_rpn[:char_to_mutate] + prev_rpn[char_to_mutate + 1:]
+            values = values[:char_to_mutate] + values[char_to_mutate + 1:]
             newstate = State(self.voc, newrpn, self.calculus_mode)
 
         else:  # or mutate
             prev_rpn[char_to_mutate] = newchar
+            if newchar != char:
+                values[char_to_mutate] = None
             newstate = State(self.voc, prev_rpn, self.calculus_mode)
+        newrpn = newstate.reversepolish
 
 
         # -------- return the new state:
 
         if self.usesimplif:
             newstate = game_env.simplif_eq(self.voc, newstate)
+        self.carry_constants(newstate, newrpn, values)
 
         if self.voc.infinite_number[0] not in newstate.reversepolish:
             return True, newstate
         else:
             return False, state
 
+    # ---------------------------------------------------------------------------- #
+    # crossovers and deletions work on the rpns : the subtree of a token is a slice of the rpn (see State.spans),
+    # and swapping or deleting subtrees is a concatenation of slices. The constants follow their symbols
+
+    def swap_subtrees(self, state1, state2, starts1, starts2, which1, which2):
+        # the rpns (without halt) and the constants of the two states, once the subtrees of the tokens which1 and which2
+        # are swapped
+        rpn1 = state1.reversepolish
+        rpn2 = state2.reversepolish
+        values1 = self.constants_by_position(state1)
+        values2 = self.constants_by_position(state2)
+        start1, end1, n1 = starts1[which1], which1 + 1, len(starts1)
+        start2, end2, n2 = starts2[which2], which2 + 1, len(starts2)
+
+        newrpn1 = rpn1[:start1] + rpn2[start2:end2] + rpn1[end1:n1]
+        newrpn2 = rpn2[:start2] + rpn1[start1:end1] + rpn2[end2:n2]
+        newvalues1 = values1[:start1] + values2[start2:end2] + values1[end1:n1]
+        newvalues2 = values2[:start2] + values1[start1:end1] + values2[end2:n2]
+        return newrpn1, newvalues1, newrpn2, newvalues2
+
     # ---------------------------------------------------------------------------- #
     def crossover(self, state1, state2):
         # here i make only crossovers between eqs1 resp. and eqs 2
-        prev_state1 = copy.deepcopy(state1)
-        prev_state2 = copy.deepcopy(state2)
-        game1 = Game(self.voc, prev_state1)
-        game2 = Game(self.voc, prev_state2)
-        ast1 = game1.convert_to_ast()
-        ast2 = game2.convert_to_ast()
-        rpn1 = prev_state1.reversepolish
-        rpn2 = prev_state2.reversepolish
-
-        # throw the last '1' == halt if exists:
-        if rpn1[-1] == 1:
-            array1 = np.asarray(rpn1[:-1])
-        else:
-            array1 = np.asarray(rpn1)
-        if rpn2[-1] == 1:
-            array2 = np.asarray(rpn2[:-1])
-        else:
-            array2 = np.asarray(rpn2)
-
-        # topnode has the max absolute label, so you dont want it/ you want only subtrees, hence the [:-1]
-        # subtrees can be scalars == leaves, hence >= 2
-        start = 2 #+ len(self.voc.arity0symbols)
-
-        #get all topnodes of possible subtrees
-        positions1 = np.where(array1 >= start)[0][:-1]
-        positions2 = np.where(array2 >= start)[0][:-1]
-
-        if positions1.size > 0 and positions2.size > 0:
-            #choose two
-            which1 = np.random.choice(positions1)
-            which2 = np.random.choice(positions2)
-            getnonleafnode1 = which1 + 1
-            getnonleafnode2 = which2 + 1
-            #get the nodes
-            node1 = ast1.from_ast_get_node(ast1.topnode, getnonleafnode1)[0]
-            node2 = ast2.from_ast_get_node(ast2.topnode, getnonleafnode2)[0]
-
-            #swap parents and children == swap subtrees
-            prev1 = node1.parent
-            c = 0
-            for child in prev1.children:
-                if child == node1:
-                    prev1.children[c] = node2
-                c += 1
-
-            c = 0
-            prev2 = node2.parent
-            for child in prev2.children:
-                if child == node2:
-                    prev2.children[c] = node1
-                c += 1
-
-            #get the new reversepolish:
-            rpn1 = ast1.from_ast_to_rpn(ast1.topnode)
-            rpn2 = ast2.from_ast_to_rpn(ast2.topnode)
-
-            # but dont crossover at all if the results are eqs longer than maximal_size (see GP_QD) :
-            if len(rpn1) > self.maximal_size or len(rpn2)> self.maximal_size:
-                return False, prev_state1, prev_state2
-
-        # else cant crossover
-        else:
-            return False, prev_state1, prev_state2
-
-        #returns the new states
-        state1 = State(self.voc, rpn1, self.calculus_mode)
-        state2 = State(self.voc, rpn2, self.calculus_mode)
+        starts1, _ = state1.spans
+        starts2, _ = state2.spans
 
-        if self.usesimplif:
-            state1 = game_env.simplif_eq(self.voc, state1, self.calculus_mode)
-            state2 = game_env.simplif_eq(self.voc, state2, self.calculus_mode)
+        # the last token is the whole equation, so you dont want it/ you want only subtrees (leaves included)
+        if len(starts1) < 2 or len(starts2) < 2:
+            return False, copy.deepcopy(state1), copy.deepcopy(state2)
 
-        game1 = Game(self.voc, state1)
-        game2 = Game(self.voc, state2)
-        toreturn = []
+        #choose two
+        which1 = np.random.randint(0, len(starts1) - 1)
+        which2 = np.random.randint(0, len(starts2) - 1)
+        rpn1, values1, rpn2, values2 = self.swap_subtrees(state1, state2, starts1, starts2, which1, which2)
 
-        #crossover can lead to true zero division thus :
-        if self.voc.infinite_number[0] in state1.reversepolish :
-            toreturn.append(prev_state1)
+        # but dont crossover at all if the results are eqs longer than maximal_size (see GP_QD) :
+        if len(rpn1) > self.maximal_size or len(rpn2)> self.maximal_size:
+            return False, copy.deepcopy(state1), copy.deepcopy(state2)
 
-        # also, if it returns too many nested functions, i dont want it
-        elif game1.getnumberoffunctions() > config.MAX_DEPTH :
-            toreturn.append(prev_state1)
-        else:
-            toreturn.append(state1)
+        #returns the new states
+        newstate1 = State(self.voc, rpn1, self.calculus_mode)
+        newstate2 = State(self.voc, rpn2, self.calculus_mode)
 
-        if self.voc.infinite_number[0] in state2.reversepolish:
-            toreturn.append(prev_state2)
+        if self.usesimplif:
+            newstate1 = game_env.simplif_eq(self.voc, newstate1, self.calculus_mode)
+            newstate2 = game_env.simplif_eq(self.voc, newstate2, self.calculus_mode)
+        self.carry_constants(newstate1, rpn1, values1)
+        self.carry_constants(newstate2, rpn2, values2)
 
-        elif game2.getnumberoffunctions() > config.MAX_DEPTH :
-            toreturn.append(prev_state2)
+        return True, self.checked_offspring(newstate1, state1), self.checked_offspring(newstate2, state2)
 
-        else:
-            toreturn.append(state2)
-
-        return True, toreturn[0], toreturn[1]
+    # ---------------------------------------------------------------------------- #
+    def checked_offspring(self, newstate, state):
+        # crossover can lead to true zero division ; also, if it returns too many nested functions, i dont want it
+        # (sort of parsimony) : then (a copy of) the parent is kept instead
+        if self.voc.infinite_number[0] in newstate.reversepolish:
+            return copy.deepcopy(state)
+        elif Game(self.voc, newstate).getnumberoffunctions() > config.MAX_DEPTH:
+            return copy.deepcopy(state)
+        return newstate
 
     # ---------------------------------------------------------------------------- #
     def vectorial_crossover(self, state1, state2):
+        starts1, types1 = state1.spans
+        starts2, types2 = state2.spans
 
-        prev_state1 = copy.deepcopy(state1)
-        prev_state2 = copy.deepcopy(state2)
-        game1 = Game(self.voc, prev_state1)
-        game2 = Game(self.voc, prev_state2)
-        ast1 = game1.convert_to_ast()
-        ast2 = game2.convert_to_ast()
-        rpn1 = prev_state1.reversepolish
-        rpn2 = prev_state2.reversepolish
-
-        # throw away the last '1' (== halt) if exists:
-        if rpn1[-1] == 1:
-            array1 = np.asarray(rpn1[:-1])
-        else:
-            array1 = np.asarray(rpn1)
-        if rpn2[-1] == 1:
-            array2 = np.asarray(rpn2[:-1])
-        else:
-            array2 = np.asarray(rpn2)
-
-        # topnode has the max absolute label, so you dont want it/ you want only subtrees, hence the [:-1]
-        # subtrees can be scalars == leaves, hence >= 2
-        start = 2  # + len(self.voc.arity0symbols)
-
-        # get all topnodes of possible subtrees
-        positions1 = np.where(array1 >= start)[0][:-1]
-        positions2 = np.where(array2 >= start)[0][:-1]
-
-        if positions1.size > 0 and positions2.size > 0:
-            # choose two
-            which1 = np.random.choice(positions1)
-            which2 = np.random.choice(positions2)
-
-            getnonleafnode1 = which1 + 1
-            getnonleafnode2 = which2 + 1
-
-            # get the nodes
-            node1 = ast1.from_ast_get_node(ast1.topnode, getnonleafnode1)[0]
-            node2 = ast2.from_ast_get_node(ast2.topnode, getnonleafnode2)[0]
-
-            before_swap_rpn1 = ast1.from_ast_to_rpn(node1)
-            before_swap_rpn2 = ast2.from_ast_to_rpn(node2)
-
-            bfstate1 = State(self.voc, before_swap_rpn1, self.calculus_mode)
-            bfstate2 = State(self.voc, before_swap_rpn2, self.calculus_mode)
-
-            bef_game1 = Game(self.voc, bfstate1)
-            bef_game2 = Game(self.voc, bfstate2)
-
-            _, vec_number1, _ = bef_game1.from_rpn_to_critical_info()
-            _, vec_number2, _ = bef_game2.from_rpn_to_critical_info()
-
-            if vec_number1 == vec_number2:
-                # swap parents and children == swap subtrees
-                prev1 = node1.parent
-                c = 0
-                for child in prev1.children:
-                    if child == node1:
-                        prev1.children[c] = node2
-                    c += 1
-
-                c = 0
-                prev2 = node2.parent
-                for child in prev2.children:
-                    if child == node2:
-                        prev2.children[c] = node1
-                    c += 1
-
-                # get the new reversepolish:
-                rpn1 = ast1.from_ast_to_rpn(ast1.topnode)
-                rpn2 = ast2.from_ast_to_rpn(ast2.topnode)
-
-                # but dont crossover at all if the results are eqs longer than maximal_size (see GP_QD) :
-                if len(rpn1) > self.maximal_size or len(rpn2) > self.maximal_size:
-                    return False, prev_state1, prev_state2
-            else:  #cant crossover vector and scalar
-                return False, prev_state1, prev_state2
-
-        # else cant crossover
-        else:
-            return False, prev_state1, prev_state2
+        # the last token is the whole equation, so you dont want it/ you want only subtrees (leaves included)
+        if len(starts1) < 2 or len(starts2) < 2:
+            return False, copy.deepcopy(state1), copy.deepcopy(state2)
 
-        # returns the new states
-        state1 = State(self.voc, rpn1, self.calculus_mode)
-        state2 = State(self.voc, rpn2, self.calculus_mode)
+        # choose two
+        which1 = np.random.randint(0, len(starts1) - 1)
+        which2 = np.random.randint(0, len(starts2) - 1)
 
-        if self.usesimplif:
-            state1 = game_env.simplif_eq(self.voc, state1)
-            state2 = game_env.simplif_eq(self.voc, state2)
+        #cant crossover vector and scalar
+        if types1[which1] != types2[which2]:
+            return False, copy.deepcopy(state1), copy.deepcopy(state2)
+        rpn1, values1, rpn2, values2 = self.swap_subtrees(state1, state2, starts1, starts2, which1, which2)
 
-        game1 = Game(self.voc, state1)
-        game2 = Game(self.voc, state2)
+        # but dont crossover at all if the results are eqs longer than maximal_size (see GP_QD) :
+        if len(rpn1) > self.maximal_size or len(rpn2) > self.maximal_size:
+            return False, copy.deepcopy(state1), copy.deepcopy(state2)
 
-        toreturn = []
+        # returns the new states
+        newstate1 = State(self.voc, rpn1, self.calculus_mode)
+        newstate2 = State(self.voc, rpn2, self.calculus_mode)
 
-        # crossover can lead to true zero division thus :
-        if self.voc.infinite_number[0] in state1.reversepolish:
-            toreturn.append(prev_state1)
+        if self.usesimplif:
+            newstate1 = game_env.simplif_eq(self.voc, newstate1)
+            newstate2 = game_env.simplif_eq(self.voc, newstate2)
+        self.carry_constants(newstate1, rpn1, values1)
+        self.carry_constants(newstate2, rpn2, values2)
 
-        # also, if it returns too many nested functions, i dont want it (sort of parsimony)
-        elif game1.getnumberoffunctions() > config.MAX_DEPTH:
-            toreturn.append(prev_state1)
-        else:
-            toreturn.append(state1)
+        return True, self.checked_offspring(newstate1, state1), self.checked_offspring(newstate2, state2)
 
-        if self.voc.infinite_number[0] in state2.reversepolish:
-            toreturn.append(prev_state2)
-            # print('fail')
+    # ---------------------------------------------------------------------------- #
+    def vectorial_delete_one_subtree(self, state):
+        #if possible, this selects a binary node (not the whole equation) and replaces it by its left or right operand
+        starts, types = state.spans
+        rpn = state.reversepolish
+        n = len(starts)
+        if n == 0:
+            return False, copy.deepcopy(state)
+
+        maxretries = 10
+        got_one = False
+        count = 0
+        while got_one is False and count < maxretries:
+            which = np.random.randint(0, n)
+            count += 1
+            if self.voc.token_arity[rpn[which]] == 2 and which < n - 1:
+                got_one = True
+
+        if got_one == False:
+            return False, copy.deepcopy(state)
+
+        # the right operand ends just before the operator, the left one just before the right one
+        right = which - 1
+        left = starts[right] - 1
+        vecs = [types[left], types[right]]
+
+        if vecs == [0, 0]:
+            if random.random() < 0.5:
+                kept = left
+            else:
+                kept = right
 
-        elif game2.getnumberoffunctions() > config.MAX_DEPTH:
-            toreturn.append(prev_state2)
+        elif vecs == [0, 1]:
+            kept = right
 
-        else:
-            toreturn.append(state2)
+        elif vecs == [1, 0]:
+            kept = left
 
-        return True, toreturn[0], toreturn[1]
+        elif vecs == [1, 1] and self.voc.token_kind[rpn[which]] != 'dot': #exclude dot product
+            if random.random() < 0.5:
+                kept = left
+            else:
+                kept = right
 
-    # ---------------------------------------------------------------------------- #
-    def vectorial_delete_one_subtree(self, state):
-        #if possible, this selects a node and deletes either left or right subtree
-        prev_state = copy.deepcopy(state)
-        game = Game(self.voc, prev_state)
-        ast = game.convert_to_ast()
-        rpn = prev_state.reversepolish
-
-        # throw away the last '1' (== halt) if exists:
-        if rpn[-1] == 1:
-            array = np.asarray(rpn[:-1])
-        else:
-            array = np.asarray(rpn)
-
-        start = 2
-
-        # get all topnodes of possible subtrees
-        positions = np.where(array >= start)[0]
-
-        if positions.size > 0 :
-            maxretries = 10
-            got_one = False
-            count=0
-            while got_one is False and count < maxretries:
-                which = np.random.choice(positions)
-                getnonleafnode = which + 1
-                # get the node
-                operatornode = ast.from_ast_get_node(ast.topnode, getnonleafnode)[0]
-                before_swap_rpn = ast.from_ast_to_rpn(operatornode)
-                bfstate = State(self.voc, before_swap_rpn, self.calculus_mode)
-                bef_game = Game(self.voc, bfstate)
-                _, vec_number, _ = bef_game.from_rpn_to_critical_info()
-                grandparent = operatornode.parent
-                count+=1
-                if before_swap_rpn[-1] in self.voc.arity2symbols and grandparent is not None :
-                    got_one = True
-                    count = 0
-                    for child in grandparent.children:
-                        if child == operatornode:
-                            index = count
-                        count+=1
-
-            if got_one == False:
-                return False, prev_state
+        else: # dot product case
+            return False, copy.deepcopy(state)
 
-            else:
-                vecs = []
-                for child in operatornode.children:
-                    rpnchild = ast.from_ast_to_rpn(child)
-                    statechild = State(self.voc, rpnchild, self.calculus_mode)
-                    gamechild = Game(self.voc, statechild)
-                    _, vec_number, _ = gamechild.from_rpn_to_critical_info()
-                    vecs.append(vec_number)
-
-                if vecs == [0,0]:
-                    if random.random() <0.5:
-                        newnode = operatornode.children[0]
-                        #print('delete right')
-                    else:
-                        newnode = operatornode.children[1]
-                        #print('delete left')
-
-                elif vecs == [0, 1]:
-                    newnode = operatornode.children[1]
-                    #print('delete left')
-
-                elif vecs == [1, 0]:
-                    newnode = operatornode.children[0]
-                    #print('delete right')
-
-
-                elif vecs == [1, 1] and before_swap_rpn[-1] != self.voc.dot_number: #exclude dot product
-                    if random.random() <0.5:
-                        newnode = operatornode.children[0]
-                        #print('delete right')
-
-                    else:
-                        newnode = operatornode.children[1]
-                        #print('delete left')
-
-                else: # dot product case
-                    return False, prev_state
-
-                grandparent.children[index] = newnode
-                newrpn = ast.from_ast_to_rpn(ast.topnode)
-
-        # else cant delete tree
-        else:
-            return False, prev_state
+        values = self.constants_by_position(state)
+        newrpn = rpn[:starts[which]] + rpn[starts[kept]:kept + 1] + rpn[which + 1:n]
+        values = values[:starts[which]] + values[starts[kept]:kept + 1] + values[which + 1:n]
 
         # returns the new states
         state = State(self.voc, newrpn, self.calculus_mode)
+        self.carry_constants(state, newrpn, values)
 
         return True, state
\ No newline at end of file
@@ -66,22 +66,33 @@ class GP_QD():
         newgame = game_env.randomeqs(self.voc)
         return newgame.state
 
+    # ----------------------
+    def random_states(self, n):
+        # see config.random_equations
+        if config.random_equations == 'uniform':
+            return game_env.uniform_randomstates(self.voc, n)
+        else:
+            return game_env.randomstates(self.voc, n)
+
     # ---------------------------------------------------------------------------- #
     # creates or extend self.pool
     def extend_pool(self):
 
         if self.pool == None and self.QD_pool is None:
             self.pool = []
-            tasks = range(0, self.poolsize)
-            mp_pool = mp.Pool(config.cpus)
-            asyncResult = mp_pool.map_async(self.parallel_creation, tasks)
-            results = asyncResult.get()
-            mp_pool.close()
-            mp_pool.join()
+            if config.random_equations == 'uniform' or config.bulk_random_equations:
+                results = self.random_states(self.poolsize)
+            else:
+                tasks = range(0, self.poolsize)
+                mp_pool = mp.Pool(config.cpus)
+                asyncResult = mp_pool.map_async(self.parallel_creation, tasks)
+                results = asyncResult.get()
+                mp_pool.close()
+                mp_pool.join()
+                del mp_pool
             for state in results:
                 if self.voc.infinite_number[0] not in state.reversepolish:
                     self.pool.append(state)
-            del mp_pool
             return self.pool
 
         else:
@@ -105,12 +116,24 @@ class GP_QD():
 
                 st = time.time()
 
-                while c < toadd and n_tries < 2000:
-                    newgame = game_env.randomeqs(self.voc)
-                    if self.voc.infinite_number[0] not in newgame.state.reversepolish:
-                        all_states.append(newgame.state)
-                        c += 1
-                    n_tries += 1
+                if config.random_equations == 'uniform' or config.bulk_random_equations:
+                    # as many tries as one by one : the states rejected are drawn again, by batches
+                    while c < toadd and n_tries < 2000:
+                        batch = self.random_states(min(toadd - c, 2000 - n_tries))
+                        if len(batch) == 0:
+                            break
+                        for state in batch:
+                            if self.voc.infinite_number[0] not in state.reversepolish:
+                                all_states.append(state)
+                                c += 1
+                        n_tries += len(batch)
+                else:
+                    while c < toadd and n_tries < 2000:
+                        newgame = game_env.randomeqs(self.voc)
+                        if self.voc.infinite_number[0] not in newgame.state.reversepolish:
+                            all_states.append(newgame.state)
+                            c += 1
+                        n_tries += 1
                 print('completion random duration', time.time() -st)
 
             ts = time.time()
@@ -186,70 +209,81 @@ class GP_QD():
             return self.pool
 
     # ---------------------------------------------------------------------------- #
-    # bin the results
-    def bin_pool(self, results):
+    # the bin of an equation with Anumber free scalars
+    def bin_id(self, state, Anumber):
+        game = Game(self.voc, state)
+        if self.calculus_mode == 'scalar':
+            L, function_number, mytargetnumber, firstder_number, depth, varnumber = game.get_features()
+        else:
+            L, function_number, mytargetnumber, firstder_number, depth, varnumber, \
+            dotnumber, normnumber, crossnumber = game.get_features()
 
-        results_by_bin = {}
+        bins = np.linspace(0, self.bin_nscalar, num=self.bin_nscalar+1)
+        bin_scalar = np.digitize(Anumber, bins)
 
-        for oneresult in results:
-            rms, state, allA, Anumber = oneresult
-            game = Game(self.voc, state)
-            if self.calculus_mode == 'scalar':
-                L, function_number, mytargetnumber, firstder_number, depth, varnumber = game.get_features()
-            else:
-                L, function_number, mytargetnumber, firstder_number, depth, varnumber, \
-                dotnumber, normnumber, crossnumber = game.get_features()
+        bins = np.linspace(0, self.binl, num=self.binl + 1)
+        bin_l = np.digitize(L, bins)
 
-            bins = np.linspace(0, self.bin_nscalar, num=self.bin_nscalar+1)
-            bin_scalar = np.digitize(Anumber, bins)
+        bins = np.linspace(0, self.binf, num=self.binf + 1)
+        bin_f = np.digitize(function_number, bins)
 
-            bins = np.linspace(0, self.binl, num=self.binl + 1)
-            bin_l = np.digitize(L, bins)
+        bins = np.linspace(0, self.bin_depth, num=self.bin_depth + 1)
+        bin_depth = np.digitize(depth, bins)
 
-            bins = np.linspace(0, self.binf, num=self.binf + 1)
-            bin_f = np.digitize(function_number, bins)
+        bins = np.linspace(0, self.bin_target, num=self.bin_target + 1)
+        bin_targ = np.digitize(mytargetnumber, bins)
 
-            bins = np.linspace(0, self.bin_depth, num=self.bin_depth + 1)
-            bin_depth = np.digitize(depth, bins)
+        bins = np.linspace(0, self.bin_derivatives, num=self.bin_derivatives + 1)
+        bin_der = np.digitize(firstder_number, bins)
 
-            bins = np.linspace(0, self.bin_target, num=self.bin_target + 1)
-            bin_targ = np.digitize(mytargetnumber, bins)
+        bins = np.linspace(0, self.bin_var, num=self.bin_var + 1)
+        bin_var = np.digitize(varnumber, bins)
 
-            bins = np.linspace(0, self.bin_derivatives, num=self.bin_derivatives + 1)
-            bin_der = np.digitize(firstder_number, bins)
 
-            bins = np.linspace(0, self.bin_var, num=self.bin_var + 1)
-            bin_var = np.digitize(varnumber, bins)
+        if self.calculus_mode == 'vectorial':
 
+            bins = np.linspace(0, self.bin_dot, num=self.bin_dot + 1)
+            bin_dot = np.digitize(dotnumber, bins)
 
-            if self.calculus_mode == 'vectorial':
+            bins = np.linspace(0, self.bin_norm, num=self.bin_norm + 1)
+            bin_norm = np.digitize(normnumber, bins)
 
-                bins = np.linspace(0, self.bin_dot, num=self.bin_dot + 1)
-                bin_dot = np.digitize(dotnumber, bins)
+            bins = np.linspace(0, self.bin_cross, num=self.bin_cross + 1)
+            bin_cross = np.digitize(crossnumber, bins)
 
-                bins = np.linspace(0, self.bin_norm, num=self.bin_norm + 1)
-                bin_norm = np.digitize(normnumber, bins)
+            return str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var, bin_dot, bin_norm, bin_cross])
 
-                bins = np.linspace(0, self.bin_cross, num=self.bin_cross + 1)
-                bin_cross = np.digitize(crossnumber, bins)
+        return str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var])
 
+    # ---------------------------------------------------------------------------- #
+    # rms of the best equation found so far in the bin of this one (None if the bin is empty)
+    def elite_rms(self, state, Anumber):
+        if self.QD_pool is None:
+            return None
+        binid = self.bin_id(state, Anumber)
+        if binid in self.QD_pool:
+            return self.QD_pool[binid][0]
+        return None
 
-            if self.calculus_mode =='scalar':
-                if str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var]) not in results_by_bin:
-                    if rms <config.minrms:
-                        results_by_bin.update({str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var]): [rms, state, allA]})
-                else:
-                    prev_rms = results_by_bin[str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var])][0]
-                    if rms < prev_rms:
-                        results_by_bin.update({str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var]): [rms, state, allA]})
+    # ---------------------------------------------------------------------------- #
+    # bin the results
+    def bin_pool(self, results):
+
+        results_by_bin = {}
+
+        for oneresult in results:
+            rms, state, allA, Anumber = oneresult
+            # offsprings of this state will start their fit from these constants
+            state.fitted_A = allA
+            binid = self.bin_id(state, Anumber)
+
+            if binid not in results_by_bin:
+                if rms <config.minrms:
+                    results_by_bin.update({binid: [rms, state, allA]})
             else:
-                if str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var, bin_dot, bin_norm, bin_cross]) not in results_by_bin:
-                    if rms <config.minrms:
-                        results_by_bin.update({str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var, bin_dot, bin_norm, bin_cross]): [rms, state, allA]})
-                else:
-                    prev_rms = results_by_bin[str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var, bin_dot, bin_norm, bin_cross])][0]
-                    if rms < prev_rms:
-                        results_by_bin.update({str([bin_scalar, bin_l, bin_f, bin_depth, bin_targ, bin_der, bin_var, bin_dot, bin_norm, bin_cross]): [rms, state, allA]})
+                prev_rms = results_by_bin[binid][0]
+                if rms < prev_rms:
+                    results_by_bin.update({binid: [rms, state, allA]})
 
         return results_by_bin
 
@@ -365,8 +399,8 @@ class printresults():
             elif self.lookfor == 'find_2nd_order_diff_eq': #its only 1D diff eq
                 rename = '(' + str(self.ranges[self.n_variables]) + ')/(' + str(self.ranges[0])+'**2)' +'*(' + rename + ')'
 
-        # .reshape SIZE not useful either :
-        rename = rename.replace('axis=1).reshape(SIZE, 1)', 'axis=0)')
+        # keepdims not useful either :
+        rename = rename.replace(', axis = -1, keepdims = True)', ', axis = -1)')
         #rename = rename.replace('np.', '')
 
         return rename
@@ -407,8 +441,8 @@ class printresults():
 
         if np.isnan(bestreward) or np.isinf(bestreward):
             bestreward = 100000000
-        evaluate = Evaluatefit(best_formula, self.voc, self.target, 'train', u, look_for)
-        evaluate.rename_formulas()
+        evaluate = Evaluatefit(best_formula, self.voc, self.target, 'train', u, look_for, best_state.reversepolish)
+        evaluate.compile_equation()
 
         if self.calculusmode == 'scalar':
             validation_reward = evaluate.eval_reward_nrmse(with_a_best)
@@ -447,8 +481,8 @@ class printresults():
 
             formula = state.formulas
 
-            evaluate = Evaluatefit(formula, self.voc, self.target, 'train',u, look_for)
-            evaluate.rename_formulas()
+            evaluate = Evaluatefit(formula, self.voc, self.target, 'train',u, look_for, state.reversepolish)
+            evaluate.compile_equation()
             if self.calculusmode == 'scalar':
                 avg_validation_reward += evaluate.eval_reward_nrmse(with_a)
             else:
@@ -23,7 +23,10 @@ import csv
 import sys
 import numpy as np
 from Evaluate_fit import Evaluatefit
+import Evaluate_rpn
 import pickle
+import collections
+import fitness_store
 
 
 
@@ -37,13 +40,10 @@ def convert_eqs(qdpool, voc_a, voc_no_a, diff, calculus_mode):
 
         newstate = []
         for char in state.reversepolish:
-            if char in voc_no_a.terminalsymbol:
+            kind = voc_no_a.token_kind[char]
+            if kind == 'halt':
                 newstate.append(voc_a.terminalsymbol[0])
-            elif char in voc_no_a.neutral_element:
-                newstate.append(voc_a.pure_numbers[0])
-            elif char in voc_no_a.true_zero_number:
-                newstate.append(voc_a.pure_numbers[0])
-            elif char in voc_no_a.pure_numbers:
+            elif kind == 'neutral' or kind == 'zero' or kind == 'number':
                 newstate.append(voc_a.pure_numbers[0])
             else:
                 # shift everything : warning, works only if pure numbers are in the beginning of our dictionnaries!
@@ -61,8 +61,8 @@ def convert_eqs(qdpool, voc_a, voc_no_a, diff, calculus_mode):
             creastate = game_env.simplif_eq(voc_a, creastate)
 
         if voc_a.infinite_number not in creastate.reversepolish:
-            if str(creastate.reversepolish) not in local_alleqs:
-                local_alleqs.update({str(creastate.reversepolish): 1})
+            if game_env.state_key(creastate) not in local_alleqs:
+                local_alleqs.update({game_env.state_key(creastate): 1})
                 initpool.append(creastate)
 
     del local_alleqs
@@ -76,9 +76,21 @@ def eval_previous_eqs(train_targets, voc_a, u, initpool, gp, look_for, calculus_
     # init all eqs seen so far
     alleqs = {}
 
+    # equations fitted by an earlier run are not fitted again
+    stored = {}
+    if config.fitness_store:
+        store = fitness_store.FitnessStore(train_targets, u, voc_a, look_for)
+        stored = store.load()
+
     pool_to_eval = []
+    reused = []
     for state in initpool:
-        pool_to_eval.append([train_targets, voc_a, state, u, look_for])
+        key = game_env.state_key(state)
+        if key in stored:
+            rms, _, alla, scalar_numbers = stored[key]
+            reused.append([rms, fitted_state(stored[key], voc_a), alla, scalar_numbers])
+        else:
+            pool_to_eval.append([train_targets, voc_a, state, u, look_for])
 
     mp_pool = mp.Pool(config.cpus)
     print('how many states to eval : ', len(pool_to_eval))
@@ -87,8 +99,12 @@ def eval_previous_eqs(train_targets, voc_a, u, initpool, gp, look_for, calculus_
     mp_pool.close()
     mp_pool.join()
 
+    if config.fitness_store:
+        remember(store, results, voc_a)
+    results = results + reused
+
     for result in results:
-        alleqs.update({str(result[1].reversepolish): result})
+        alleqs.update({game_env.state_key(result[1]): result})
 
     # bin the results
     results_by_bin = gp.bin_pool(results)
@@ -154,8 +170,11 @@ def save_qd_pool(pool, qdpoolname):
 # -------------------------------------------------------------------------- #
 def evalme(onestate):
     train_targets, voc, state, u, look_for = onestate[0], onestate[1], onestate[2], onestate[3], onestate[4]
+    starttime = time.time()
     results = []
-    scalar_numbers, alla, rms = game_env.game_evaluate(state.reversepolish, state.formulas, voc, train_targets, 'train',u, look_for)
+    # warm start inherited from the parents, if any (states pickled by older versions have none)
+    initial_A = getattr(state, 'initial_A', None)
+    scalar_numbers, alla, rms = game_env.game_evaluate(state.reversepolish, state.formulas, voc, train_targets, 'train',u, look_for, initial_A)
     results.append([rms, scalar_numbers, alla])
 
     if config.tworunsineval:
@@ -166,16 +185,181 @@ def evalme(onestate):
         else:
             rms, scalar_numbers, alla = results[1]
 
+    # cost of the fit, for the fitness store
+    state.fit_cost = time.time() - starttime
     return rms, state, alla, scalar_numbers
 
+# -------------------------------------------------------------------------- #
+def remember(store, results, voc):
+    # writes the results of evalme to the fitness store
+    fits = []
+    for rms, state, alla, scalar_numbers in results:
+        fits.append([game_env.state_key(state), state.reversepolish, rms, alla, scalar_numbers,
+                     getattr(state, 'fit_cost', 0.)])
+    store.write(fits)
+
+# -------------------------------------------------------------------------- #
+def fitted_state(fit, voc):
+    # the state a remembered fit was done for : its constants follow the order of this rpn, not of the other
+    # orderings of the same equation. Fits of the fitness store come with the rpn only
+    if isinstance(fit[1], State):
+        return fit[1]
+    return State(voc, fit[1], voc.calculus_mode)
+
+# -------------------------------------------------------------------------- #
+def evalme_subsample(onestate):
+    # cheap fit, on a fraction of the data and with a tight cma-es budget
+    train_targets, voc, state, u, look_for, fraction = onestate
+    if voc.infinite_number[0] in state.reversepolish:
+        return 100000000, state, [], 0
+
+    myfit = Evaluatefit(state.formulas, voc, train_targets, 'train', u, look_for, state.reversepolish,
+                        getattr(state, 'initial_A', None))
+    myfit.subsample(fraction)
+    myfit.max_evaluations = config.racing_max_evaluations
+    scalar_numbers, alla, rms = myfit.evaluate()
+    return rms, state, alla, scalar_numbers
+
+# -------------------------------------------------------------------------- #
+def race(train_targets, u, voc, pool, gp, look_for):
+    # successive halving : states are fitted on growing fractions of the data, and those clearly worse than the elite
+    # of their bin are dropped before the full fit. Survivors start the next fit from the constants found
+    n_points = np.size(train_targets[0][1][0])
+    fractions = [fraction for fraction in config.racing_fractions if fraction*n_points >= config.racing_min_points]
+    if len(fractions) == 0:
+        return pool
+
+    # only states whose bin already has an elite can be dropped : the others go straight to the full fit
+    contenders = []
+    newbins = []
+    for state in pool:
+        # the number of free scalars only : compiling the rpn does not touch the data
+        scalar_numbers = Evaluate_rpn.compile_rpn(state.reversepolish, voc).scalar_numbers
+        if gp.elite_rms(state, scalar_numbers) is None:
+            newbins.append(state)
+        else:
+            contenders.append(state)
+
+    for fraction in fractions:
+        pool_to_eval = []
+        for state in contenders:
+            pool_to_eval.append([train_targets, voc, state, u, look_for, fraction])
+
+        mp_pool = mp.Pool(config.cpus)
+        asyncResult = mp_pool.map_async(evalme_subsample, pool_to_eval)
+        results = asyncResult.get()
+        mp_pool.close()
+        mp_pool.join()
+
+        survivors = []
+        for rms, state, alla, scalar_numbers in results:
+            elite = gp.elite_rms(state, scalar_numbers)
+            if elite is None or rms <= config.racing_margin * elite:
+                if rms < 100000000:
+                    state.initial_A = alla
+                survivors.append(state)
+
+        print('racing on', fraction, 'of the data:', len(survivors), 'states out of', len(contenders), 'go on')
+        contenders = survivors
+
+    return newbins + contenders
+
+# -------------------------------------------------------------------------- #
+def recall_seen(pool, local_alleqs, voc):
+    # equations fitted in an earlier iteration (or run) are not sent to the pool again : their best result so far is reused.
+    # The config.refit_fraction most promising of them are refitted anyway, starting from their best constants
+    new_states = []
+    repeats = []
+    keys = {}
+    for state in pool:
+        key = game_env.state_key(state)
+        if key in keys:
+            continue
+        keys.update({key: 1})
+        if key in local_alleqs:
+            repeats.append(key)
+        else:
+            new_states.append(state)
+
+    repeats = sorted(repeats, key=lambda key: local_alleqs[key][0])
+    n_refit = int(np.ceil(config.refit_fraction * len(repeats)))
+
+    refits = []
+    reused = []
+    for k, key in enumerate(repeats):
+        rms, _, alla, scalar_numbers = local_alleqs[key]
+        state = fitted_state(local_alleqs[key], voc)
+        if k < n_refit:
+            state.initial_A = alla
+            refits.append(state)
+        else:
+            reused.append([rms, state, alla, scalar_numbers])
+
+    print('already seen:', len(repeats), 'out of', len(pool), 'states,', len(refits), 'refitted')
+    return new_states, refits, reused
+
+# -------------------------------------------------------------------------- #
+def drop_equivalent(train_targets, u, voc, pool, look_for, fingerprints):
+    # states giving the same values as an equation fitted before (or kept before them in this pool), and not shorter
+    # than it, are not fitted : see Evaluatefit.fingerprint. fingerprints : {fingerprint : length of the rpn}, of the
+    # equations whose fit came back only (see register_fingerprints) : states dropped by the racing or the prescreen
+    # do not hide their equivalents in later iterations. Also returns the fingerprints of the kept states : {state key : (fingerprint, length)}
+    kept = []
+    pending = {}
+    in_pool = {}
+    for state in pool:
+        fingerprint = Evaluatefit(state.formulas, voc, train_targets, 'train', u, look_for, state.reversepolish).fingerprint()
+        if fingerprint is not None:
+            length = len(state.reversepolish)
+            if fingerprint in fingerprints and fingerprints[fingerprint] <= length:
+                continue
+            if fingerprint in in_pool and in_pool[fingerprint] <= length:
+                continue
+            in_pool.update({fingerprint: length})
+            pending.update({game_env.state_key(state): (fingerprint, length)})
+        kept.append(state)
+
+    print('semantic duplicates:', len(pool) - len(kept), 'out of', len(pool), 'states')
+    return kept, pending
+
+def register_fingerprints(results, pending, fingerprints):
+    # the fingerprints of the states that were fitted : their equivalents are not fitted any more. A failed fit (or a
+    # state rejected by the prescreen, see Evaluatefit.hopeless) gets the 100000000 reward and hides nothing
+    for result in results:
+        key = game_env.state_key(result[1])
+        if key in pending and result[0] < 100000000:
+            fingerprint, length = pending[key]
+            if fingerprint not in fingerprints or length < fingerprints[fingerprint]:
+                fingerprints.update({fingerprint: length})
+
 # -------------------------------------------------------------------------- #
 def exec(train_targets, u, voc, iteration, gp, look_for, calculus_mode, name, qdpoolname, starttime):
 
     local_alleqs = {}
+    # fits of this run, then fits of earlier runs on the same data
+    known = local_alleqs
+    if config.fitness_store:
+        store = fitness_store.FitnessStore(train_targets, u, voc, look_for)
+        stored = store.load()
+        print('fits loaded from the store:', len(stored))
+        known = collections.ChainMap(local_alleqs, stored)
+    fingerprints = {}
+
     for i in range(iteration):
         print('')
         print('this is iteration', i)
         pool = gp.extend_pool()
+        reused = []
+        if config.fitness_memo:
+            pool, refits, reused = recall_seen(pool, known, voc)
+        else:
+            refits = []
+        pending = {}
+        if config.semantic_dedup:
+            pool, pending = drop_equivalent(train_targets, u, voc, pool, look_for, fingerprints)
+        if config.fitness_racing and gp.QD_pool is not None:
+            pool = race(train_targets, u, voc, pool, gp, look_for)
+        pool = pool + refits
 
         pool_to_eval = []
         for state in pool:
@@ -187,14 +371,22 @@ def exec(train_targets, u, voc, iteration, gp, look_for, calculus_mode, name, qd
         mp_pool.close()
         mp_pool.join()
 
-        for result in results:
+        if config.fitness_store:
+            remember(store, results, voc)
+        register_fingerprints(results, pending, fingerprints)
+
+        for k, result in enumerate(results):
             # this is for the fact that an equation that has already been seen might return a better reward,
             # because cmaes method is not perfect!
-            if str(result[1].reversepolish) in local_alleqs:
-                if result[0] < local_alleqs[str(result[1].reversepolish)][0]:
-                    local_alleqs.update({str(result[1].reversepolish): result})
-            else:
-                local_alleqs.update({str(result[1].reversepolish): result})
+            key = game_env.state_key(result[1])
+            if key in known and result[0] >= known[key][0]:
+                # a refit that did worse keeps the best result found so far
+                rms, _, alla, scalar_numbers = known[key]
+                results[k] = [rms, fitted_state(known[key], voc), alla, scalar_numbers]
+            local_alleqs.update({key: results[k]})
+        for result in reused:
+            local_alleqs.setdefault(game_env.state_key(result[1]), result)
+        results = results + reused
 
         results_by_bin = gp.bin_pool(results)
 
@@ -235,7 +427,7 @@ def main(params, train_targets, u, look_for, calculus_mode, maximal_size, name):
 
     if config.verifonegivenfunction:
         formula = 'A+A*x0'
-        scalar_numbers, alla, rms = game_env.game_evaluate([1], formula, voc_a, train_targets, 'train', u, look_for)
+        scalar_numbers, alla, rms = Evaluatefit(formula, voc_a, train_targets, 'train', u, look_for).evaluate()
         print('returns: ', scalar_numbers, alla, rms)
         time.sleep(4.1)
 
@@ -0,0 +1,31 @@
+# shared fixtures : a vocabulary on the Keijzer1 data of data_loader
+import os
+import sys
+import pickle
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import utils_mainrun
+from Targets import Voc
+
+
+@pytest.fixture
+def keijzer1(tmp_path, monkeypatch):
+    # (voc with free scalars, train targets)
+    monkeypatch.chdir(root)
+    data = pickle.load(open('data_loader/Keijzer1.txt', 'rb'))
+    data.setdefault('maxlen', 20)
+    data.setdefault('n_variables', 1)
+    path = str(tmp_path / 'Keijzer1.txt')
+    pickle.dump(data, open(path, 'wb'))
+    n_variables, names, train_targets, maxsize = utils_mainrun.init_targets([path, 'scalar', 'no_diff'])
+    voc = Voc(0, n_variables, names, 'scalar', maxsize[0], 'find_function', [True, False, False], 'A')
+    return voc, train_targets
+
+
+@pytest.fixture
+def voc(keijzer1):
+    return keijzer1[0]
@@ -0,0 +1,46 @@
+# the numba backend on equations with literals (zero, neutral) : same residuals as the numpy backend
+import numpy as np
+import pytest
+
+import config
+import Evaluate_backends
+from Evaluate_fit import Evaluatefit
+
+pytest.importorskip('numba')
+
+
+def rpn_of(voc, symbols):
+    return [voc.token_formula.index(symbol) for symbol in symbols]
+
+
+@pytest.mark.parametrize('literal', ['neutral', 'zero'])
+def test_literals(keijzer1, monkeypatch, literal):
+    voc, train_targets = keijzer1
+    monkeypatch.setattr(config, 'evaluation_backend', 'numba')
+    monkeypatch.setattr(config, 'jit_min_points', 1)
+    # (A*x0) + literal
+    rpn = rpn_of(voc, ['A', 'x0', '*', literal, '+', 'halt'])
+    X = np.random.RandomState(0).rand(5, 2)
+
+    residuals = {}
+    for backend in ['numba', 'numpy']:
+        monkeypatch.setattr(config, 'evaluation_backend', backend)
+        fit = Evaluatefit(None, voc, train_targets, 'train', 0, 'find_function', rpn)
+        fit.compile_equation()
+        residuals[backend] = (type(fit.backend), fit.backend.residual(X))
+
+    assert residuals['numba'][0] is Evaluate_backends.NumbaBackend
+    assert np.allclose(residuals['numba'][1], residuals['numpy'][1])
+
+
+def test_fallback_when_numba_fails(keijzer1, monkeypatch):
+    voc, train_targets = keijzer1
+    monkeypatch.setattr(config, 'evaluation_backend', 'numba')
+    monkeypatch.setattr(config, 'jit_min_points', 1)
+
+    def broken(source):
+        raise RuntimeError
+    monkeypatch.setattr(Evaluate_backends, 'jit', broken)
+    fit = Evaluatefit(None, voc, train_targets, 'train', 0, 'find_function', rpn_of(voc, ['A', 'x0', '*', 'halt']))
+    fit.compile_equation()
+    assert type(fit.backend) is Evaluate_backends.NumpyBackend
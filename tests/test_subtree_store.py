@@ -0,0 +1,30 @@
+# states read before the subtree store starts again (see State.SubtreeStore) keep their formulas and keys
+import random
+
+import numpy as np
+
+import config
+import game_env
+from State import State
+
+
+def test_states_survive_a_reset(voc, monkeypatch):
+    random.seed(0)
+    np.random.seed(0)
+    states = game_env.randomstates(voc, 300)
+    before = [(game_env.state_key(state), state.formulas) for state in states]
+    generation = voc.subtrees.generation
+
+    # a tiny store : it starts again many times while other equations are read
+    monkeypatch.setattr(config, 'subtree_store_size', 20)
+    for state in game_env.randomstates(voc, 300):
+        game_env.state_key(state)
+    assert voc.subtrees.generation > generation
+
+    for state, (key, formula) in zip(states, before):
+        assert game_env.state_key(state) == key
+        assert state.formulas == formula
+        # the same equation, read from scratch in the new store
+        fresh = State(voc, state.reversepolish, 'scalar')
+        assert fresh.formulas == formula
+        assert game_env.state_key(fresh) == key